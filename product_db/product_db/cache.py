@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import time
+from typing import Any, Hashable, Iterable
+
+from product_db.settings import PRODUCT_CACHE_MAX_BYTES, PRODUCT_CACHE_TTL_SECONDS
+
+
+class ResponseCache:
+    # LRU cache of serialized responses with a TTL and a total size budget in bytes.
+    # The event loop is single threaded, so no locking is needed.
+    #
+    # Every invalidation bumps the generation. A reader takes the generation before querying
+    # the database and put() drops its value if a write was applied in the meantime, so a
+    # read racing with the consumer cannot store an outdated row.
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[float, bytes]] = OrderedDict()
+
+    def get(self, key: Hashable) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: bytes, generation: int):
+        if generation != self.generation or len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        self.generation += 1
+        for key in keys:
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: Hashable):
+        _, value = self._entries.pop(key)
+        self.size -= len(value)
+
+
+# Serialized GET /products/{id} responses keyed by database id
+product_cache = ResponseCache(PRODUCT_CACHE_MAX_BYTES, PRODUCT_CACHE_TTL_SECONDS)
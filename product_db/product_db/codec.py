@@ -0,0 +1,27 @@
+import json
+from typing import Any
+
+from product_db.proto import product_pb2
+
+
+# Protobuf events start with a zero byte followed by the schema version. A JSON event always
+# starts with "{", so both formats can be consumed from the same topic.
+MAGIC_BYTE = b"\x00"
+SCHEMA_VERSION = 1
+HEADER = MAGIC_BYTE + bytes([SCHEMA_VERSION])
+
+OPTIONAL_FIELDS = ("id", "product_id", "name", "description", "price", "category")
+
+
+def decode_product(value: bytes) -> dict[str, Any]:
+    if not value.startswith(MAGIC_BYTE):
+        return json.loads(value)
+
+    version = value[1] if len(value) > 1 else None
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported product event schema version {version}")
+    event = product_pb2.ProductEvent.FromString(value[len(HEADER):])
+    product: dict[str, Any] = {"operation": product_pb2.Operation.Name(event.operation)}
+    for field in OPTIONAL_FIELDS:
+        product[field] = getattr(event, field) if event.HasField(field) else None
+    return product
@@ -1,75 +1,308 @@
-import json
+import asyncio
+from functools import partial
 import logging
+import random
+from typing import Any, Awaitable, Callable
 
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRebalanceListener, ConsumerRecord, TopicPartition
+from aiokafka.errors import CommitFailedError, KafkaError, KafkaTimeoutError, MessageSizeTooLargeError
+from product_db import metrics
+from product_db.cache import product_cache
+from product_db.codec import decode_product
 from product_db.consumers.consumer import create_consumer
-from product_db.models import ProductConsumer, ProductStore
+from product_db.crud import apply_products, load_offsets, save_offsets
 from product_db.db import engine
-from product_db.settings import KAFKA_PRODUCT_CONSUMER_GROUP_ID, KAFKA_PRODUCT_TOPIC
-from sqlmodel import Session, select
+from product_db.dead_letters import send_dead_letter
+from product_db.producers.producer import create_producer, stop_producer
+from product_db.settings import (CONSUMER_MAX_RETRIES, CONSUMER_RETRY_BACKOFF_MS, CONSUMER_RETRY_MAX_BACKOFF_MS,
+                                 KAFKA_CONSUMER_BATCH_SIZE, KAFKA_CONSUMER_BATCH_TIMEOUT_MS,
+                                 KAFKA_PRODUCT_CONSUMER_GROUP_ID, KAFKA_PRODUCT_STATE_TOPIC, KAFKA_PRODUCT_TOPIC)
+from product_db.state import publish_states
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
 logging.basicConfig(level= logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def consume_products():
-    consumer = await create_consumer(KAFKA_PRODUCT_TOPIC, KAFKA_PRODUCT_CONSUMER_GROUP_ID)
+class PartitionsRevoked(Exception):
+    pass
+
+
+class BatchLock:
+    # Orders the database work of a worker's batches with rebalances. A revocation waits for the
+    # operation in progress, not for the backoff between retries. Operations of a batch fetched
+    # before the last revocation are refused, its partitions resume from the stored offsets.
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.generation = 0
+
+    async def revoke(self):
+        async with self.lock:
+            self.generation += 1
+
+    async def run(self, generation: int, operation: Callable[[], Awaitable[Any]]) -> Any:
+        async with self.lock:
+            if generation != self.generation:
+                raise PartitionsRevoked("Partitions of the batch were revoked")
+            return await operation()
+
+
+class StoredOffsetsListener(ConsumerRebalanceListener):
+    # Offsets stored in Postgres together with the products are the source of truth,
+    # newly assigned partitions resume right after the last stored batch
+    def __init__(self, consumer: AIOKafkaConsumer, batch_lock: BatchLock):
+        self.consumer = consumer
+        self.batch_lock = batch_lock
+
+    async def on_partitions_revoked(self, revoked):
+        # Let the batch operation in progress finish before the partitions move to another worker,
+        # so the new owner reads offsets that include it
+        await self.batch_lock.revoke()
+        for tp in revoked:
+            metrics.consumer_lag.remove(tp.topic, str(tp.partition))
+
+    async def on_partitions_assigned(self, assigned):
+        await seek_stored_offsets(self.consumer, set(assigned))
+
+async def seek_stored_offsets(consumer: AIOKafkaConsumer, partitions: set[TopicPartition]):
+    if not partitions:
+        return
+    async with AsyncSession(engine) as session:
+        with metrics.db_latency.time("load_offsets"):
+            offsets = await load_offsets(session, KAFKA_PRODUCT_CONSUMER_GROUP_ID, partitions)
+    # Another rebalance may have taken partitions away while the offsets were loaded
+    assigned = consumer.assignment()
+    for tp, offset in offsets.items():
+        if tp in assigned:
+            consumer.seek(tp, offset)
+            logger.info(f"Resuming {tp.topic}[{tp.partition}] from stored offset {offset}")
+
+async def get_batch(consumer: AIOKafkaConsumer) -> list[ConsumerRecord]:
+    # Collects records until the batch is full or the time window has passed.
+    # Records of one partition keep their order, getmany() returns them in offset order.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + KAFKA_CONSUMER_BATCH_TIMEOUT_MS / 1000
+    records: list[ConsumerRecord] = []
+    while len(records) < KAFKA_CONSUMER_BATCH_SIZE:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        batches = await consumer.getmany(timeout_ms=int(remaining * 1000),
+                                         max_records=KAFKA_CONSUMER_BATCH_SIZE - len(records))
+        for partition_records in batches.values():
+            records.extend(partition_records)
+    return records
+
+def record_batch(consumer: AIOKafkaConsumer, records: list[ConsumerRecord]):
+    # Lag is the partition head reported with the last fetch minus the next offset to consume,
+    # both known locally, so no extra request is made to Kafka
+    metrics.consumer_batch_size.observe(value=len(records))
+    counts: dict[TopicPartition, int] = {}
+    for msg in records:
+        tp = TopicPartition(msg.topic, msg.partition)
+        counts[tp] = counts.get(tp, 0) + 1
+    offsets = next_offsets(records)
+    for tp, count in counts.items():
+        partition = str(tp.partition)
+        metrics.consumer_messages.inc(tp.topic, partition, amount=count)
+        highwater = consumer.highwater(tp)
+        if highwater is not None:
+            metrics.consumer_lag.set(tp.topic, partition, value=max(0, highwater - offsets[tp]))
+
+def parse_records(records: list[ConsumerRecord]) -> tuple[list[tuple[ConsumerRecord, dict[str, Any]]],
+                                                       list[tuple[ConsumerRecord, Exception]]]:
+    products = []
+    invalid = []
+    for msg in records:
+        try:
+            products.append((msg, decode_product(msg.value)))
+        except Exception as e:
+            invalid.append((msg, e))
+            metrics.consumer_errors.inc("decode")
+    return products, invalid
+
+def next_offsets(records: list[ConsumerRecord]) -> dict[TopicPartition, int]:
+    offsets = {}
+    for msg in records:
+        offsets[TopicPartition(msg.topic, msg.partition)] = msg.offset + 1
+    return offsets
+
+def is_transient(error: Exception) -> bool:
+    # Errors worth retrying: the database or the broker was unreachable or the connection was lost
+    return isinstance(error, (OperationalError, InterfaceError, TimeoutError, ConnectionError, KafkaTimeoutError)) or (
+        isinstance(error, DBAPIError) and error.connection_invalidated) or (
+        isinstance(error, KafkaError) and error.retriable)
+
+def is_data_error(error: Exception) -> bool:
+    # Errors caused by the events themselves, only these are dead-lettered. Other Kafka errors
+    # (e.g. a missing permission on the state topic) would fail every event alike, the batch is
+    # consumed again until they are resolved.
+    if is_transient(error) or isinstance(error, PartitionsRevoked):
+        return False
+    return not isinstance(error, KafkaError) or isinstance(error, MessageSizeTooLargeError)
+
+async def with_retries(operation: Callable[[], Awaitable[Any]], description: str) -> Any:
+    # Transient errors are retried with exponential backoff and jitter, anything else is raised at once
+    for attempt in range(CONSUMER_MAX_RETRIES + 1):
+        try:
+            return await operation()
+        except Exception as e:
+            if not is_transient(e) or attempt == CONSUMER_MAX_RETRIES:
+                raise
+            metrics.consumer_errors.inc("transient")
+            delay = min(CONSUMER_RETRY_BACKOFF_MS * 2 ** attempt, CONSUMER_RETRY_MAX_BACKOFF_MS) / 1000
+            delay *= random.uniform(0.5, 1)
+            logger.warning(f"Transient error {description}, retry {attempt + 1}/{CONSUMER_MAX_RETRIES} "
+                           f"in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+async def dead_letter(producer: AIOKafkaProducer, msg: ConsumerRecord, error: Exception | str,
+                      dead_lettered: set[tuple[str, int, int]]):
+    # A batch that is retried or consumed again does not publish its dead letters twice
+    position = (msg.topic, msg.partition, msg.offset)
+    if position in dead_lettered:
+        return
+    await send_dead_letter(producer, msg, error)
+    dead_lettered.add(position)
+
+async def apply_events(products: list[tuple[ConsumerRecord, dict[str, Any]]], offsets: dict[TopicPartition, int],
+                       producer: AIOKafkaProducer, dead_lettered: set[tuple[str, int, int]]):
+    # One transaction for the events and their offsets. Updates of missing products are
+    # dead-lettered and the new product states published before the commit, so a failed
+    # delivery rolls the batch back.
+    async with AsyncSession(engine) as session:
+        missing: list[dict[str, Any]] = []
+        with metrics.db_latency.time("apply_products"):
+            changed = await apply_products(session, [product for _, product in products], missing)
+        records = {id(product): msg for msg, product in products}
+        for product in missing:
+            await dead_letter(producer, records[id(product)], "Product not found for update", dead_lettered)
+        if KAFKA_PRODUCT_STATE_TOPIC:
+            with metrics.db_latency.time("publish_states"):
+                await publish_states(producer, session, products, changed)
+        with metrics.db_latency.time("save_offsets"):
+            await save_offsets(session, KAFKA_PRODUCT_CONSUMER_GROUP_ID, offsets)
+        with metrics.db_latency.time("commit"):
+            await session.commit()
+    product_cache.invalidate(changed)
+
+async def store_offsets(offsets: dict[TopicPartition, int]):
+    async with AsyncSession(engine) as session:
+        with metrics.db_latency.time("save_offsets"):
+            await save_offsets(session, KAFKA_PRODUCT_CONSUMER_GROUP_ID, offsets)
+        with metrics.db_latency.time("commit"):
+            await session.commit()
+
+async def store_products(records: list[ConsumerRecord], producer: AIOKafkaProducer, batch_lock: BatchLock,
+                         generation: int, dead_lettered: set[tuple[str, int, int]]):
+    # The whole batch and its offsets are one transaction. If it fails for a reason other than a
+    # transient error, the events are applied one by one (each with its own offset) and the ones
+    # that still fail are dead-lettered, so a poison event neither blocks nor stops the partition.
+    # Raises when the database or the broker stays unavailable, the caller consumes the batch again
+    # later, and PartitionsRevoked when a rebalance took the batch away between two operations.
+    # Cached responses of changed products are dropped once the transaction is committed.
+    def locked(operation: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        return partial(batch_lock.run, generation, operation)
+
+    products, invalid = parse_records(records)
+    for msg, error in invalid:
+        await locked(partial(dead_letter, producer, msg, error, dead_lettered))()
+    try:
+        await with_retries(locked(partial(apply_events, products, next_offsets(records), producer, dead_lettered)),
+                           f"storing batch of {len(products)} products")
+        return
+    except Exception as e:
+        if not is_data_error(e):
+            raise
+        metrics.consumer_errors.inc("batch")
+        logger.error(f"Error storing batch of {len(products)} products, retrying one by one: {e}")
+
+    for msg, product in products:
+        try:
+            await with_retries(locked(partial(apply_events, [(msg, product)], next_offsets([msg]), producer,
+                                              dead_lettered)),
+                               f"storing event at {msg.topic}[{msg.partition}]@{msg.offset}")
+        except Exception as e:
+            if not is_data_error(e):
+                raise
+            metrics.consumer_errors.inc("event")
+            await locked(partial(dead_letter, producer, msg, e, dead_lettered))()
+    await with_retries(locked(partial(store_offsets, next_offsets(records))), "storing offsets")
+
+def rewind(consumer: AIOKafkaConsumer, records: list[ConsumerRecord]):
+    # Positions the consumer at the first record of the batch again, unless the partition has
+    # been reassigned in the meantime (its new owner resumes from the stored offsets)
+    first_offsets: dict[TopicPartition, int] = {}
+    for msg in records:
+        first_offsets.setdefault(TopicPartition(msg.topic, msg.partition), msg.offset)
+    assigned = consumer.assignment()
+    for tp, offset in first_offsets.items():
+        if tp in assigned:
+            consumer.seek(tp, offset)
+
+async def resume_dropped_batch(consumer: AIOKafkaConsumer, records: list[ConsumerRecord]):
+    # A batch spanning a rebalance may hold records fetched after the new assignment was positioned
+    # at the stored offsets, dropping it would skip them. The partitions of the batch this worker
+    # still owns go back to the stored offsets, or to the first record of the batch where none is
+    # stored or the database can't be reached.
+    rewind(consumer, records)
+    partitions = {TopicPartition(msg.topic, msg.partition) for msg in records}
+    try:
+        await seek_stored_offsets(consumer, partitions & consumer.assignment())
+    except Exception as e:
+        logger.error(f"Could not load stored offsets, resuming from the start of the dropped batch: {e}")
+
+async def consume_products(worker: int = 0):
+    # Every worker is a member of the same consumer group. Kafka gives each partition to exactly
+    # one member, so events of a partition are always applied in order by a single worker.
+    batch_lock = BatchLock()
+    dead_lettered: set[tuple[str, int, int]] = set()
+    consumer = await create_consumer(KAFKA_PRODUCT_TOPIC, KAFKA_PRODUCT_CONSUMER_GROUP_ID,
+                                     enable_auto_commit=False,
+                                     rebalance_listener=partial(StoredOffsetsListener, batch_lock=batch_lock))
     if not consumer:
-        logger.error("Failed to create kafka product consumer")
+        logger.error(f"Failed to create kafka product consumer {worker}")
+        return
+    producer = await create_producer()
+    if not producer:
+        logger.error(f"Failed to create producer of consumer {worker}")
+        await consumer.stop()
         return
 
     try:
-        async for msg in consumer:
+        while True:
+            generation = batch_lock.generation
+            records = await get_batch(consumer)
+            if not records:
+                continue
+            logger.info(f"Worker {worker} received batch of {len(records)} messages")
+            record_batch(consumer, records)
             try:
-                # Parse the JSON message
-                product = json.loads(msg.value)
-                logger.info(f"Received Message: {product}")
-
-                with Session(engine) as session:
-                    logger.info(f"Session has started!")
-                    if product.get("operation") in ["CREATE", "Create", "create"]:
-                        logger.info(f"Create command received and updating Database now!")
-                        # Your code to handle the CREATE operation                        
-                        new_product = ProductStore(
-                            name=product.get("name"),
-                            product_id=product.get("product_id"),
-                            description=product.get("description"),
-                            price=product.get("price"),
-                            category=product.get("category")
-                        )
-                        session.add(new_product)
-                        session.commit()
-                        session.refresh(new_product)
-                        logger.info(f'Product added to db: {new_product}')
-                    
-                    elif product.get("operation") in ["UPDATE", "Update", "update"]:
-                        existing_product = session.exec(select(ProductStore).where(ProductStore.id == int(product.get("id")))).first()
-                        if existing_product:
-                            existing_product.name = product.get("name")
-                            existing_product.product_id = product.get("product_id")
-                            existing_product.description = product.get("description")
-                            existing_product.price = product.get("price")
-                            existing_product.category = product.get("category")
-                            session.add(existing_product)
-                            session.commit()
-                            session.refresh(existing_product)
-                            logger.info(f'Product updated in db: {existing_product}')
-                        else:
-                            logger.warning(f"Product with ID {product.get("id")} not found")
-
-                    elif product.get("operation") in ["DELETE", "Delete", "delete"]:
-                        existing_product = session.exec(select(ProductStore).where(ProductStore.id == int(product.get("id")))).first()
-                        if existing_product:
-                            session.delete(existing_product)
-                            session.commit()
-                            logger.info(f"Product with ID {product.get("id")} successfully deleted")
-                        else:
-                            logger.warning(f"Product with ID {product.get("id")} not found for deletion")
-
+                await store_products(records, producer, batch_lock, generation, dead_lettered)
+            except PartitionsRevoked:
+                logger.info(f"Worker {worker} dropped a batch spanning a rebalance")
+                await resume_dropped_batch(consumer, records)
+                continue
             except Exception as e:
-                logger.error(f"Error processing message: {e}")
+                metrics.consumer_errors.inc("rewind")
+                logger.error(f"Worker {worker} could not store batch, consuming it again: {e}")
+                if generation == batch_lock.generation:
+                    rewind(consumer, records)
+                else:
+                    await resume_dropped_batch(consumer, records)
+                await asyncio.sleep(CONSUMER_RETRY_MAX_BACKOFF_MS / 1000)
+                continue
+            dead_lettered.clear()
+            # The stored offsets are authoritative, the Kafka commit keeps group lag tooling accurate
+            try:
+                await consumer.commit()
+            except CommitFailedError as e:
+                logger.warning(f"Worker {worker} could not commit offsets to Kafka during a rebalance: {e}")
 
     finally:
+        await stop_producer(producer)
         await consumer.stop()
-        logger.info("Consumer stopped")
-    return
\ No newline at end of file
+        logger.info(f"Consumer {worker} stopped")
+    return
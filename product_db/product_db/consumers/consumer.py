@@ -1,5 +1,8 @@
 import asyncio
-from aiokafka import AIOKafkaConsumer
+from typing import Callable
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from aiokafka.coordinator.assignors.roundrobin import RoundRobinPartitionAssignor
+from aiokafka.coordinator.assignors.sticky.sticky_assignor import StickyPartitionAssignor
 from product_db.settings import BOOTSTRAP_SERVER
 
 import logging
@@ -12,18 +15,28 @@ MAX_RETRIES = 5
 RETRY_INTERVAL = 10
 
 
-async def create_consumer(topic: str, group_id: str):
+async def create_consumer(
+        topic: str,
+        group_id: str,
+        enable_auto_commit: bool = True,
+        rebalance_listener: Callable[[AIOKafkaConsumer], ConsumerRebalanceListener] | None = None
+):
     retries = 0
     while retries < MAX_RETRIES:
         try:
             consumer = AIOKafkaConsumer(
-                topic,
                 bootstrap_servers=BOOTSTRAP_SERVER,
                 group_id=group_id,
                 auto_offset_reset='earliest',
-                enable_auto_commit=True,
-                auto_commit_interval_ms=5000
+                enable_auto_commit=enable_auto_commit,
+                auto_commit_interval_ms=5000,
+                # Sticky assignment keeps partitions on their current owner when workers join or leave,
+                # round robin stays listed so members running an older version can still join the group
+                partition_assignment_strategy=(StickyPartitionAssignor, RoundRobinPartitionAssignor)
             )
+            # The listener is built with the consumer so it can seek on partition assignment
+            listener = rebalance_listener(consumer) if rebalance_listener else None
+            consumer.subscribe([topic], listener=listener)
             await consumer.start()
             logger.info(f"Consumer for topic {topic} started successfully.")
             return consumer
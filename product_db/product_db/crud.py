@@ -0,0 +1,207 @@
+import logging
+import math
+from itertools import groupby
+from typing import Any, AsyncIterator
+
+from aiokafka import TopicPartition
+from sqlalchemy import column, tuple_, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import col, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from product_db.models import ConsumerOffset, ProductStore
+
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+PRODUCT_FIELDS = ("product_id", "name", "description", "price", "category")
+
+
+def product_columns(fields: str | None) -> list:
+    # Projection for the listing endpoints. The id is always returned because it is the cursor.
+    requested = [name.strip() for name in fields.split(",")] if fields else PRODUCT_FIELDS
+    names = list(dict.fromkeys(["id", *filter(None, requested)]))
+    table = ProductStore.__table__
+    unknown = [name for name in names if name not in table.c]
+    if unknown:
+        raise ValueError(f"Unknown product fields: {', '.join(unknown)}")
+    return [table.c[name] for name in names]
+
+def select_products(columns: list, after_id: int | None = None, limit: int | None = None):
+    # Keyset pagination: every page is an index range scan on the primary key starting after
+    # the last id of the previous page, however deep the page is.
+    statement = select(*columns).order_by(col(ProductStore.id))
+    if after_id is not None:
+        statement = statement.where(col(ProductStore.id) > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+def search_products(columns: list, category: str | None = None, min_price: float | None = None,
+                    max_price: float | None = None, product_id: str | None = None,
+                    cursor: str | None = None, limit: int | None = None) -> tuple[Any, list]:
+    # Picks the ordering an index serves for the given filters and continues after the cursor:
+    # product_id is a unique lookup, a price range is ordered by (price, id) on the (category,)
+    # price, id index, anything else by id on the (category, id) index or the primary key.
+    # Returns the statement and the ordering columns, which are also the cursor.
+    order = [col(ProductStore.price), col(ProductStore.id)] if min_price is not None or max_price is not None \
+        else [col(ProductStore.id)]
+    selected = {column.name for column in columns}
+    statement = select(*columns, *(column for column in order if column.name not in selected)).order_by(*order)
+    if product_id is not None:
+        statement = statement.where(col(ProductStore.product_id) == product_id)
+    if category is not None:
+        statement = statement.where(col(ProductStore.category) == category)
+    if min_price is not None:
+        statement = statement.where(col(ProductStore.price) >= min_price)
+    if max_price is not None:
+        statement = statement.where(col(ProductStore.price) <= max_price)
+    if cursor is not None:
+        statement = statement.where(tuple_(*order) > tuple_(*parse_cursor(cursor, order)))
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement, order
+
+def parse_cursor(cursor: str, order: list) -> list:
+    # "<id>" or "<price>:<id>", matching the ordering of the query it came from
+    values = cursor.split(":")
+    if len(values) != len(order):
+        raise ValueError("Cursor does not match the filters of this query")
+    try:
+        parsed = [float(value) if column.name == "price" else int(value) for value, column in zip(values, order)]
+    except ValueError:
+        raise ValueError(f"Invalid cursor {cursor}")
+    # float() also accepts "nan" and "inf", which no stored price can be compared against
+    if not all(math.isfinite(value) for value in parsed):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return parsed
+
+def format_cursor(row: dict[str, Any], order: list) -> str:
+    return ":".join(repr(row[column.name]) if column.name == "price" else str(row[column.name]) for column in order)
+
+async def stream_products(session: AsyncSession, columns: list, after_id: int | None,
+                          chunk_size: int) -> AsyncIterator[list[dict[str, Any]]]:
+    # Rows are fetched from a server side cursor chunk_size at a time, memory use does not
+    # depend on the size of the catalog
+    statement = select_products(columns, after_id).execution_options(yield_per=chunk_size)
+    result = await session.stream(statement)
+    async for rows in result.mappings().partitions():
+        yield [dict(row) for row in rows]
+
+def get_operation(product: dict[str, Any]) -> str | None:
+    operation = product.get("operation")
+    return operation.upper() if isinstance(operation, str) else None
+
+def get_key(product: dict[str, Any]) -> str:
+    # Events are keyed by product_id, the Kafka message key. Events published before keying
+    # was introduced address the product by its database id instead.
+    return "id" if product.get("id") is not None else "product_id"
+
+def _key_value(product: dict[str, Any], key: str) -> Any:
+    return product[key] if key == "product_id" else int(product[key])
+
+def _run_key(product: dict[str, Any]) -> tuple:
+    # Consecutive events with the same operation, key (and, for updates, the same set of changed
+    # fields) are applied with a single statement. Splitting runs on any change keeps the
+    # statements in the same order as the messages.
+    operation = get_operation(product)
+    if operation == "UPDATE":
+        key = get_key(product)
+        return operation, key, tuple(field for field in PRODUCT_FIELDS
+                                     if field != key and product.get(field) is not None)
+    if operation == "DELETE":
+        return operation, get_key(product), ()
+    return operation, "product_id", ()
+
+async def apply_products(session: AsyncSession, products: list[dict[str, Any]],
+                         missing: list[dict[str, Any]] | None = None) -> set[int]:
+    # Applies a batch of product events inside the caller's transaction, the caller commits.
+    # All events of one product come from one partition in order, and runs are applied in
+    # message order, so the per-product order of the topic is kept.
+    # Returns the database ids of all changed rows, updates of products that do not exist are
+    # appended to missing.
+    changed: set[int] = set()
+    for (operation, key, fields), run in groupby(products, key=_run_key):
+        run = list(run)
+        if operation == "CREATE":
+            changed |= await insert_products(session, run)
+        elif operation == "UPDATE":
+            changed |= await update_products(session, run, key, fields, missing)
+        elif operation == "DELETE":
+            changed |= await delete_products(session, run, key)
+        else:
+            logger.warning(f"Skipping {len(run)} product event(s) with unknown operation {operation}")
+    return changed
+
+async def insert_products(session: AsyncSession, products: list[dict[str, Any]]) -> set[int]:
+    # Upsert on product_id so a replayed CREATE overwrites the row instead of duplicating it.
+    # One statement may only touch each product_id once, the latest event wins.
+    rows = {product.get("product_id"): {field: product.get(field) for field in PRODUCT_FIELDS}
+            for product in products}
+    statement = insert(ProductStore)
+    statement = statement.on_conflict_do_update(
+        index_elements=[col(ProductStore.product_id)],
+        set_={field: statement.excluded[field] for field in PRODUCT_FIELDS if field != "product_id"}
+    ).returning(col(ProductStore.id))
+    changed = set((await session.exec(statement, params=list(rows.values()))).scalars())
+    logger.info(f"Upserted {len(rows)} product(s)")
+    return changed
+
+async def update_products(session: AsyncSession, products: list[dict[str, Any]], key: str, fields: tuple[str, ...],
+                          missing_products: list[dict[str, Any]] | None = None) -> set[int]:
+    if not fields:
+        return set()
+    # Later updates of the same row win, a VALUES list may only match each row once
+    latest = {_key_value(product, key): product for product in products}
+    table = ProductStore.__table__
+    key_column = col(getattr(ProductStore, key))
+    changes = values(
+        column(key, table.c[key].type),
+        *(column(field, table.c[field].type) for field in fields),
+        name="changes"
+    ).data([(value, *(product[field] for field in fields)) for value, product in latest.items()])
+    statement = (
+        update(ProductStore)
+        .where(key_column == changes.c[key])
+        .values({field: changes.c[field] for field in fields})
+        .returning(key_column, col(ProductStore.id))
+    )
+    updated = (await session.exec(statement)).all()
+    missing = latest.keys() - {row[0] for row in updated}
+    if missing:
+        logger.warning(f"Products with {key} {sorted(missing)} not found for update")
+        if missing_products is not None:
+            missing_products.extend(product for product in products if _key_value(product, key) in missing)
+    logger.info(f"Updated {len(updated)} product(s)")
+    return {row[1] for row in updated}
+
+async def delete_products(session: AsyncSession, products: list[dict[str, Any]], key: str) -> set[int]:
+    keys = {_key_value(product, key) for product in products}
+    key_column = col(getattr(ProductStore, key))
+    statement = delete(ProductStore).where(key_column.in_(keys)).returning(key_column, col(ProductStore.id))
+    deleted = (await session.exec(statement)).all()
+    missing = keys - {row[0] for row in deleted}
+    if missing:
+        logger.warning(f"Products with {key} {sorted(missing)} not found for deletion")
+    logger.info(f"Deleted {len(deleted)} product(s)")
+    return {row[1] for row in deleted}
+
+async def load_offsets(session: AsyncSession, group_id: str, partitions: set[TopicPartition]) -> dict[TopicPartition, int]:
+    statement = select(ConsumerOffset).where(ConsumerOffset.group_id == group_id,
+                                             col(ConsumerOffset.topic).in_({tp.topic for tp in partitions}))
+    stored = {TopicPartition(row.topic, row.partition): row.offset for row in await session.exec(statement)}
+    return {tp: offset for tp, offset in stored.items() if tp in partitions}
+
+async def save_offsets(session: AsyncSession, group_id: str, offsets: dict[TopicPartition, int]):
+    # Part of the caller's transaction, offsets are the next offset to consume
+    if not offsets:
+        return
+    rows = [{"group_id": group_id, "topic": tp.topic, "partition": tp.partition, "offset": offset}
+            for tp, offset in offsets.items()]
+    statement = insert(ConsumerOffset)
+    statement = statement.on_conflict_do_update(
+        index_elements=[col(ConsumerOffset.group_id), col(ConsumerOffset.topic), col(ConsumerOffset.partition)],
+        set_={"offset": statement.excluded["offset"]}
+    )
+    await session.exec(statement, params=rows)
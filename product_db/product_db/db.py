@@ -1,25 +1,59 @@
-from sqlmodel import SQLModel, create_engine, Session
+import logging
+
+from sqlalchemy import delete, inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from product_db import settings
+from product_db.models import ProductStore
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
 
 #Create Engine
     # Engine is used to establish the connection between our app and our db (container or neon)
     # Engine is one for whole application
     # Psycopg translates Python code and data structures into commands and data formats that PostgreSQL understands, enabling seamless interaction between your application and the database.
+    # The async engine lets the consumer and the API wait on the database without blocking the event loop,
+    # psycopg 3 provides the async driver for the same "postgresql+psycopg" url.
 connection_string: str = str(settings.DATABASE_URL).replace("postgresql", "postgresql+psycopg")
-engine = create_engine(connection_string, pool_recycle=300, pool_size=10, echo=True) 
+engine = create_async_engine(connection_string, pool_recycle=300, pool_size=10, echo=True) 
     #Echo shows all the steps performed in the terminal
 
 # engine = create_engine(setting.DATABASE_URL)
 
 #Create tables
-def create_tables():
-    SQLModel.metadata.create_all(engine)
+def _remove_duplicate_products(connection):
+    # Before product_id was unique, replayed CREATE events inserted products again. Only the latest
+    # row of each product_id (the highest id) is kept, so the unique index can be built.
+    table = ProductStore.__table__
+    unique = any(index["unique"] and index["column_names"] == ["product_id"]
+                 for index in inspect(connection).get_indexes(table.name))
+    if unique:
+        return
+    newer = table.alias("newer")
+    statement = delete(table).where(table.c.product_id == newer.c.product_id, table.c.id < newer.c.id)
+    removed = connection.execute(statement).rowcount
+    if removed:
+        logger.warning(f"Removed {removed} duplicate product row(s) before building the unique product_id index")
+
+def _create_tables(connection):
+    SQLModel.metadata.create_all(connection)
+    # create_all skips tables that already exist, make sure indexes added later are there too
+    _remove_duplicate_products(connection)
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+async def create_tables():
+    async with engine.begin() as connection:
+        await connection.run_sync(_create_tables)
 
 #Create Session
     # for every fuction/transaction there will be a new session
     # E.g for every new logged in user, a new session is made
     # when user logs out, session closes
     # we are creating our session in a generator function so it closes the session automatically whenever we dont need it
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with AsyncSession(engine) as session:
         yield session
\ No newline at end of file
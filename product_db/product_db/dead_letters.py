@@ -0,0 +1,117 @@
+# Events that cannot be applied are published to KAFKA_PRODUCT_DEAD_LETTER_TOPIC unchanged, with the
+# reason and their original position in the message headers. Once the cause is fixed they are sent
+# back to the topic they came from:
+#   python -m product_db.dead_letters             replays the dead letters not replayed before
+#   python -m product_db.dead_letters --dry-run   only lists them
+import argparse
+import asyncio
+import logging
+import time
+
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRecord, TopicPartition
+from product_db import metrics
+from product_db.producers.producer import create_producer, stop_producer
+from product_db.settings import (BOOTSTRAP_SERVER, KAFKA_PRODUCT_CONSUMER_GROUP_ID, KAFKA_PRODUCT_DEAD_LETTER_TOPIC,
+                                 KAFKA_PRODUCT_TOPIC)
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+HEADER_PREFIX = "dead_letter."
+MAX_ERROR_LENGTH = 1000
+# The replay remembers its position in its own consumer group
+REPLAY_GROUP_ID = f"{KAFKA_PRODUCT_CONSUMER_GROUP_ID}.dead_letter_replay"
+REPLAY_POLL_TIMEOUT_MS = 1000
+
+
+def dead_letter_headers(msg: ConsumerRecord, error: Exception | str) -> list[tuple[str, bytes]]:
+    metadata = {
+        "topic": msg.topic,
+        "partition": msg.partition,
+        "offset": msg.offset,
+        "timestamp": msg.timestamp,
+        "error_type": type(error).__name__ if isinstance(error, Exception) else "Rejected",
+        "error": str(error)[:MAX_ERROR_LENGTH],
+        "failed_at": int(time.time() * 1000),
+    }
+    headers = [(name, value) for name, value in (msg.headers or ()) if not name.startswith(HEADER_PREFIX)]
+    return headers + [(HEADER_PREFIX + name, str(value).encode('utf-8')) for name, value in metadata.items()]
+
+async def send_dead_letter(producer: AIOKafkaProducer, msg: ConsumerRecord, error: Exception | str):
+    # Raises if the dead letter could not be delivered, the caller must not skip the event then
+    await producer.send_and_wait(KAFKA_PRODUCT_DEAD_LETTER_TOPIC, msg.value, key=msg.key,
+                                 headers=dead_letter_headers(msg, error))
+    metrics.dead_letters.inc()
+    logger.error(f"Dead-lettered event at {msg.topic}[{msg.partition}]@{msg.offset}: {error}")
+
+
+async def replay(dry_run: bool = False) -> int:
+    # Replays the dead letters present when the command starts. Each one goes back to its original
+    # topic with its original key, so it lands on the partition of its product again.
+    consumer = AIOKafkaConsumer(bootstrap_servers=BOOTSTRAP_SERVER, group_id=REPLAY_GROUP_ID,
+                                enable_auto_commit=False, auto_offset_reset="earliest")
+    await consumer.start()
+    producer = None
+    if not dry_run:
+        producer = await create_producer()
+        if not producer:
+            await consumer.stop()
+            raise Exception("Failed to create kafka producer, no dead letters were replayed")
+    replayed = 0
+    try:
+        await consumer.topics()
+        partitions = [TopicPartition(KAFKA_PRODUCT_DEAD_LETTER_TOPIC, partition)
+                      for partition in consumer.partitions_for_topic(KAFKA_PRODUCT_DEAD_LETTER_TOPIC) or ()]
+        if not partitions:
+            logger.info(f"Topic {KAFKA_PRODUCT_DEAD_LETTER_TOPIC} does not exist, nothing to replay")
+            return 0
+        consumer.assign(partitions)
+        end_offsets = await consumer.end_offsets(partitions)
+        remaining = {tp for tp in partitions if await consumer.position(tp) < end_offsets[tp]}
+
+        while remaining:
+            batches = await consumer.getmany(*remaining, timeout_ms=REPLAY_POLL_TIMEOUT_MS)
+            offsets = {}
+            deliveries = []
+            for tp, messages in batches.items():
+                for msg in messages:
+                    if msg.offset >= end_offsets[tp]:
+                        break
+                    headers = dict(msg.headers or ())
+                    topic = headers.get(HEADER_PREFIX + "topic", KAFKA_PRODUCT_TOPIC.encode('utf-8')).decode('utf-8')
+                    error = headers.get(HEADER_PREFIX + "error", b"").decode('utf-8')
+                    logger.info(f"{'Would replay' if dry_run else 'Replaying'} dead letter "
+                                f"{tp.partition}@{msg.offset} to {topic}: {error}")
+                    if producer:
+                        deliveries.append(await producer.send(
+                            topic, msg.value, key=msg.key,
+                            headers=[(name, value) for name, value in (msg.headers or ())
+                                     if not name.startswith(HEADER_PREFIX)]))
+                    offsets[tp] = msg.offset + 1
+                    replayed += 1
+            if producer and offsets:
+                # Commit only what was delivered, an interrupted replay resumes where it stopped.
+                # A failed send only shows in its future, it raises here before the commit.
+                for delivery in deliveries:
+                    await delivery
+                await consumer.commit(offsets)
+            for tp in list(remaining):
+                if await consumer.position(tp) >= end_offsets[tp]:
+                    remaining.discard(tp)
+    finally:
+        if producer:
+            await stop_producer(producer)
+        await consumer.stop()
+    logger.info(f"{'Found' if dry_run else 'Replayed'} {replayed} dead letter(s)")
+    return replayed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Replay the events of {KAFKA_PRODUCT_DEAD_LETTER_TOPIC}")
+    parser.add_argument("--dry-run", action="store_true", help="only list the dead letters")
+    args = parser.parse_args()
+    asyncio.run(replay(args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
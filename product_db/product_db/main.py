@@ -1,38 +1,58 @@
 import asyncio
 from contextlib import asynccontextmanager
+import json
 import logging
-from typing import List, Any
+from typing import Annotated, List, Any
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from product_db import metrics
+from product_db.auth import authenticated_user
+from product_db.cache import product_cache
 from product_db.consumers.consume_products import consume_products
+from product_db.crud import format_cursor, product_columns, search_products, select_products, stream_products
 from product_db.models import ProductConsumer, ProductStore
-from sqlmodel import Session, select
+from product_db.rebuild import bootstrap
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from product_db.db import create_tables, engine, get_session
+from product_db.settings import KAFKA_CONSUMER_WORKERS
 
 
 logging.basicConfig(level= logging.INFO)
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     logger.info('Creating Tables')
-    create_tables()
+    await create_tables()
     logger.info("Tables Created")
 
+    # A new consumer group starts from the state topic or a snapshot (KAFKA_PRODUCT_BOOTSTRAP),
+    # without it the consumers replay the whole topic
+    try:
+        await bootstrap()
+    except Exception as e:
+        logger.error(f"Bootstrap failed, consuming the product topic from the earliest offset: {e}")
+
     # await create_topic()
 
     loop = asyncio.get_event_loop()
     tasks = [
-        loop.create_task(consume_products())
+        loop.create_task(consume_products(worker)) for worker in range(KAFKA_CONSUMER_WORKERS)
     ]
     
     yield
 
     for task in tasks:
         task.cancel()
-        await task
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 app = FastAPI(lifespan=lifespan, title="Product Consumer Service", version='1.0.0')
@@ -41,16 +61,90 @@ app = FastAPI(lifespan=lifespan, title="Product Consumer Service", version='1.0.
 async def root() -> Any:
     return {"message": "Welcome to Products Consumer and Database Service"}
 
-@app.get("/products/", response_model=List[ProductStore])
-async def get_products():
-    with Session(engine) as session:
-        products = session.exec(select(ProductStore)).all()
-        return products
+def get_columns(fields: str | None) -> list:
+    try:
+        return product_columns(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# Products ordered by id, one page at a time. When the page is full the X-Next-Cursor header holds
+# the after_id of the next page. fields is a comma separated projection, e.g. fields=name,price
+@app.get("/products/")
+async def get_products(
+    session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    after_id: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE,
+    fields: str | None = None
+) -> List[dict[str, Any]]:
+    columns = get_columns(fields)
+    products = [dict(row) for row in (await session.exec(select_products(columns, after_id, limit))).mappings()]
+    if len(products) == limit:
+        response.headers["X-Next-Cursor"] = str(products[-1]["id"])
+    return products
+
+# Filtered browsing. The filters decide the order: by (price, id) when a price bound is given,
+# else by id. When the page is full the X-Next-Cursor header holds the cursor of the next page,
+# pass it back with the same filters.
+@app.get("/products/search")
+async def search(
+    session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    category: str | None = None,
+    min_price: float | None = None,
+    max_price: float | None = None,
+    product_id: str | None = None,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE,
+    fields: str | None = None
+) -> List[dict[str, Any]]:
+    columns = get_columns(fields)
+    try:
+        statement, order = search_products(columns, category, min_price, max_price, product_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    rows = [dict(row) for row in (await session.exec(statement)).mappings()]
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = format_cursor(rows[-1], order)
+    # Ordering columns outside the projection were only selected for the cursor
+    names = [column.name for column in columns]
+    return [{name: row[name] for name in names} for row in rows]
+
+# The whole catalog (or everything after after_id) as NDJSON, read from a server side cursor.
+# Bulk export and the cache stats require a user_svc access token once JWKS_URL is configured.
+@app.get("/products/stream", dependencies=[Depends(authenticated_user)])
+async def get_products_stream(after_id: int | None = None, fields: str | None = None):
+    columns = get_columns(fields)
 
+    async def ndjson_products():
+        # The response outlives the request dependencies, so the stream owns its session
+        async with AsyncSession(engine) as session:
+            async for rows in stream_products(session, columns, after_id, STREAM_CHUNK_SIZE):
+                yield "".join(json.dumps(row) + "\n" for row in rows)
+
+    return StreamingResponse(ndjson_products(), media_type="application/x-ndjson")
+
+@app.get("/cache/stats", dependencies=[Depends(authenticated_user)])
+async def get_cache_stats() -> Any:
+    return product_cache.stats()
+
+# Prometheus text format. Left open like the product reads so a scraper needs no token,
+# it exposes counters only.
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+# Served from the in-process cache when possible, the consumer drops entries of changed products
 @app.get("/products/{product_id}", response_model=ProductStore)
-async def get_product(product_id: int):
-    with Session(engine) as session:
-        product = session.exec(select(ProductStore).where(ProductStore.id == product_id)).first()
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found")
-        return product
\ No newline at end of file
+async def get_product(product_id: int, session: Annotated[AsyncSession, Depends(get_session)]):
+    cached = product_cache.get(product_id)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    generation = product_cache.generation
+    product = (await session.exec(select(ProductStore).where(ProductStore.id == product_id))).first()
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    content = product.model_dump_json().encode('utf-8')
+    product_cache.put(product_id, content, generation)
+    return Response(content=content, media_type="application/json")
\ No newline at end of file
@@ -0,0 +1,162 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+from typing import Callable, Iterator, TypeVar
+
+from product_db.cache import product_cache
+
+# Metrics in the Prometheus text format, served by GET /metrics. Recording a value is a dict lookup
+# and an addition on the event loop, so the consume loop can update them per batch without locking;
+# the text is only built when /metrics is scraped.
+
+# Seconds, from a fast single-row statement to a large batch on a busy database
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric(ABC):
+    # One metric family, rendered as its HELP and TYPE lines followed by the sample lines
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        # The sample lines in the text format, one per label set
+        ...
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+    def remove(self, *labels: str):
+        self.values.pop(labels, None)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label set: observations per bucket (the last one is +Inf), sum and count
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, *labels: str, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+        entry[1][1] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, (total, count)) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {format_value(count)}"
+
+
+class Callback(Metric):
+    # Read from the callback at scrape time, for values another component already counts
+    def __init__(self, name: str, help: str, kind: str, callback: Callable[[], float]):
+        super().__init__(name, help)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {format_value(self.callback())}"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+consumer_messages = registry.register(Counter(
+    "product_db_consumer_messages_total", "Records consumed, rate() gives messages per second",
+    ("topic", "partition")))
+consumer_lag = registry.register(Gauge(
+    "product_db_consumer_lag", "Records between the partition head and the next record to consume",
+    ("topic", "partition")))
+consumer_batch_size = registry.register(Histogram(
+    "product_db_consumer_batch_size", "Records per consumed batch", buckets=BATCH_SIZE_BUCKETS))
+db_latency = registry.register(Histogram(
+    "product_db_db_operation_seconds", "Duration of the consumer's database operations", ("operation",)))
+consumer_errors = registry.register(Counter(
+    "product_db_consumer_errors_total", "Consumer errors by kind", ("kind",)))
+dead_letters = registry.register(Counter(
+    "product_db_consumer_dead_letters_total", "Events sent to the dead-letter topic"))
+
+registry.register(Callback("product_db_cache_entries", "Responses in the product cache", "gauge",
+                           lambda: product_cache.stats()["entries"]))
+registry.register(Callback("product_db_cache_bytes", "Size of the cached product responses", "gauge",
+                           lambda: product_cache.size))
+registry.register(Callback("product_db_cache_hits_total", "Product cache hits", "counter",
+                           lambda: product_cache.hits))
+registry.register(Callback("product_db_cache_misses_total", "Product cache misses", "counter",
+                           lambda: product_cache.misses))
@@ -1,5 +1,6 @@
 from typing import Optional
 from pydantic import BaseModel
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field
 
 
@@ -15,8 +16,24 @@ class ProductConsumer (BaseModel):
 class ProductStore (SQLModel, table=True):
     #This model is used to reflect the product fetched from or stored in tables in database
     id: Optional[int] = Field(default=None, primary_key=True)
-    product_id: str
+    # product_id is the business key, replayed CREATE events are upserted on it
+    product_id: str = Field(unique=True, index=True)
     name: str
     description: str
     price: float
     category: str
+
+    # Browse queries are keyset paginated on these orderings, every page is one range scan
+    __table_args__ = (
+        Index("ix_productstore_category_id", "category", "id"),
+        Index("ix_productstore_price_id", "price", "id"),
+        Index("ix_productstore_category_price_id", "category", "price", "id"),
+    )
+
+class ConsumerOffset (SQLModel, table=True):
+    # Next offset to consume per partition, written in the same transaction as the products
+    # so a restarted consumer resumes exactly after the last stored batch
+    group_id: str = Field(primary_key=True)
+    topic: str = Field(primary_key=True)
+    partition: int = Field(primary_key=True)
+    offset: int
@@ -0,0 +1,41 @@
+import asyncio
+from aiokafka import AIOKafkaProducer
+from product_db.settings import BOOTSTRAP_SERVER
+
+import logging
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+MAX_RETRIES = 5
+RETRY_INTERVAL = 10
+
+
+async def create_producer(**config) -> AIOKafkaProducer | None:
+    retries = 0
+    while retries < MAX_RETRIES:
+        producer = AIOKafkaProducer(bootstrap_servers=BOOTSTRAP_SERVER, **config)
+        try:
+            await producer.start()
+            logger.info("Producer started successfully.")
+            return producer
+        except Exception as e:
+            retries += 1
+            await producer.stop()
+            logger.error(f"Error starting producer, retry {retries}/{MAX_RETRIES}: {e}")
+            if retries < MAX_RETRIES:
+                await asyncio.sleep(RETRY_INTERVAL)
+            else:
+                logger.error("Max retries reached. Could not start producer.")
+                return None
+
+
+async def stop_producer(producer: AIOKafkaProducer):
+    # Flush whatever is still sitting in the accumulator before closing the connection
+    try:
+        await producer.flush()
+        logger.info("Producer flushed pending messages.")
+    finally:
+        await producer.stop()
+        logger.info("Producer stopped")
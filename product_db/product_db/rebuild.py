@@ -0,0 +1,300 @@
+# Rebuilds the productstore table from the product topic, e.g. after losing the database or
+# changing its schema. Run next to the service:
+#   python -m product_db.rebuild                              reads the topic from the earliest offset
+#   python -m product_db.rebuild --write-snapshot state.ndjson  also saves the folded state and offsets
+#   python -m product_db.rebuild --snapshot state.ndjson        starts from a saved state instead
+#   python -m product_db.rebuild --from-state                   starts from KAFKA_PRODUCT_STATE_TOPIC
+#   python -m product_db.rebuild --publish-state                also publishes the result to that topic
+# Events are folded per product in memory, the final rows are loaded with COPY into a new table
+# which replaces productstore in one transaction. Product ids of existing rows are kept.
+# A consumer group without stored offsets runs the same rebuild on startup from KAFKA_PRODUCT_BOOTSTRAP.
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable
+
+from aiokafka import AIOKafkaConsumer, ConsumerRecord, TopicPartition
+from product_db.codec import decode_product
+from product_db.crud import PRODUCT_FIELDS, apply_products, get_key, get_operation, load_offsets, save_offsets
+from product_db.db import create_tables, engine
+from product_db.models import ConsumerOffset, ProductStore
+from product_db.producers.producer import create_producer, stop_producer
+from product_db.settings import (BOOTSTRAP_SERVER, KAFKA_CONSUMER_BATCH_SIZE, KAFKA_PRODUCT_BOOTSTRAP,
+                                 KAFKA_PRODUCT_CONSUMER_GROUP_ID, KAFKA_PRODUCT_TOPIC)
+from product_db.state import publish_catalog, read_states
+from sqlalchemy import MetaData, text
+from sqlalchemy.schema import CreateTable
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+TABLE = ProductStore.__tablename__
+REBUILD_TABLE = f"{TABLE}_rebuild"
+COLUMNS = ("id", *PRODUCT_FIELDS)
+POLL_TIMEOUT_MS = 1000
+# Name of the advisory lock held by a running rebuild
+LOCK_NAME = "product_db.rebuild"
+
+
+class Catalog:
+    # Latest state of every product keyed by product_id, built the way the consumer applies events
+    def __init__(self, ids: dict[str, int]):
+        # Database ids of the current rows, they are kept and resolve events addressed by id
+        self.ids = ids
+        self.product_ids = {id: product_id for product_id, id in ids.items()}
+        self.products: dict[str, dict[str, Any]] = {}
+        self.events = 0
+        self.skipped = 0
+
+    def load(self, rows: dict[str, dict[str, Any]]):
+        # Starting state from a snapshot or the state topic. Their ids are kept unless the
+        # database already uses them.
+        for product_id, row in rows.items():
+            self.products[product_id] = {field: row.get(field) for field in PRODUCT_FIELDS}
+            id = row.get("id")
+            if id is not None and product_id not in self.ids and id not in self.product_ids:
+                self.ids[product_id] = id
+                self.product_ids[id] = product_id
+
+    def apply(self, product: dict[str, Any]):
+        self.events += 1
+        operation = get_operation(product)
+        product_id = product.get("product_id")
+        if operation in ("UPDATE", "DELETE") and get_key(product) == "id":
+            product_id = self.product_ids.get(int(product["id"]))
+
+        if operation == "CREATE":
+            self.products[product_id] = {field: product.get(field) for field in PRODUCT_FIELDS}
+        elif operation == "UPDATE" and product_id in self.products:
+            stored = self.products[product_id]
+            for field in PRODUCT_FIELDS:
+                if field != "product_id" and product.get(field) is not None:
+                    stored[field] = product[field]
+        elif operation == "DELETE" and product_id in self.products:
+            del self.products[product_id]
+        else:
+            self.skipped += 1
+
+
+async def read_events(consumer: AIOKafkaConsumer, start: dict[TopicPartition, int],
+                      end: dict[TopicPartition, int]) -> AsyncIterator[list[ConsumerRecord]]:
+    # Records of every partition from its start up to (excluding) its end offset
+    remaining = set()
+    for tp, offset in start.items():
+        if offset < end[tp]:
+            consumer.seek(tp, offset)
+            remaining.add(tp)
+    while remaining:
+        batches = await consumer.getmany(*remaining, timeout_ms=POLL_TIMEOUT_MS, max_records=KAFKA_CONSUMER_BATCH_SIZE)
+        for tp, records in batches.items():
+            records = [msg for msg in records if msg.offset < end[tp]]
+            if records:
+                yield records
+        # Positions, not record offsets: compacted or transactional topics have gaps
+        for tp in list(remaining):
+            if await consumer.position(tp) >= end[tp]:
+                remaining.discard(tp)
+
+def decode(records: list[ConsumerRecord]) -> list[dict[str, Any]]:
+    products = []
+    for msg in records:
+        try:
+            products.append(decode_product(msg.value))
+        except Exception as e:
+            logger.error(f"Skipping undecodable event at {msg.topic}[{msg.partition}]@{msg.offset}: {e}")
+    return products
+
+def read_snapshot(path: str) -> tuple[dict[str, dict[str, Any]], dict[int, int]]:
+    # First line: {"topic": ..., "offsets": {partition: next offset}}, then one product per line
+    with open(path, encoding="utf-8") as file:
+        header = json.loads(next(file))
+        if header["topic"] != KAFKA_PRODUCT_TOPIC:
+            raise ValueError(f"Snapshot of topic {header['topic']}, expected {KAFKA_PRODUCT_TOPIC}")
+        rows = {}
+        for line in file:
+            product = json.loads(line)
+            rows[product["product_id"]] = product
+    return rows, {int(partition): offset for partition, offset in header["offsets"].items()}
+
+def write_snapshot(path: str, catalog: Catalog, offsets: dict[TopicPartition, int]):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(json.dumps({"topic": KAFKA_PRODUCT_TOPIC,
+                               "offsets": {tp.partition: offset for tp, offset in offsets.items()}}) + "\n")
+        for product_id, product in catalog.products.items():
+            file.write(json.dumps({"id": catalog.ids.get(product_id), **product}) + "\n")
+    logger.info(f"Wrote snapshot of {len(catalog.products)} products to {path}")
+
+async def last_sequence_value(session: AsyncSession, table: str) -> int:
+    sequence = (await session.exec(text(f"SELECT pg_get_serial_sequence('{table}', 'id')"))).scalar()
+    return (await session.exec(text(f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {sequence}"))).scalar()
+
+async def load_ids() -> tuple[dict[str, int], int]:
+    # Ids of the current rows and the last id handed out by the table's sequence
+    async with AsyncSession(engine) as session:
+        ids = {product_id: id for product_id, id in await session.exec(select(ProductStore.product_id, ProductStore.id))}
+        last_id = await last_sequence_value(session, TABLE)
+    return ids, max([last_id, *ids.values()])
+
+async def load_table(catalog: Catalog, last_id: int):
+    # The new table is created from the model, so a changed schema takes effect. It is filled
+    # with COPY, the secondary indexes are built once afterwards.
+    table = ProductStore.__table__.to_metadata(MetaData(), name=REBUILD_TABLE)
+    async with engine.begin() as connection:
+        await connection.exec_driver_sql(f"DROP TABLE IF EXISTS {REBUILD_TABLE}")
+        await connection.execute(CreateTable(table))
+        raw_connection = await connection.get_raw_connection()
+        async with raw_connection.driver_connection.cursor() as cursor:
+            async with cursor.copy(f"COPY {REBUILD_TABLE} ({', '.join(COLUMNS)}) FROM STDIN") as copy:
+                for product_id, product in catalog.products.items():
+                    id = catalog.ids.get(product_id)
+                    if id is None:
+                        last_id += 1
+                        id = catalog.ids[product_id] = last_id
+                    await copy.write_row((id, *(product.get(field) for field in PRODUCT_FIELDS)))
+        for index in ProductStore.__table__.indexes:
+            columns = ", ".join(column.name for column in index.columns)
+            await connection.exec_driver_sql(f"CREATE {'UNIQUE ' if index.unique else ''}INDEX "
+                                             f"{index.name.replace(TABLE, REBUILD_TABLE)} ON {REBUILD_TABLE} ({columns})")
+        await connection.exec_driver_sql(f"ANALYZE {REBUILD_TABLE}")
+    logger.info(f"Loaded {len(catalog.products)} products into {REBUILD_TABLE}")
+
+async def swap_tables(consumer: AIOKafkaConsumer, end: dict[TopicPartition, int]):
+    # One transaction replaces the table. The lock waits for the batch a running consumer is
+    # applying and holds back the next one, then the events stored since the rebuild read the
+    # topic are applied to the new table, so running consumers continue where they were.
+    async with AsyncSession(engine) as session:
+        await session.exec(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+        stored = await load_offsets(session, KAFKA_PRODUCT_CONSUMER_GROUP_ID, set(end))
+        # Ids handed out by the old table are never reused
+        last_id = await last_sequence_value(session, TABLE)
+
+        await session.exec(text(f"DROP TABLE {TABLE}"))
+        await session.exec(text(f"ALTER TABLE {REBUILD_TABLE} RENAME TO {TABLE}"))
+        await session.exec(text(f"ALTER INDEX {REBUILD_TABLE}_pkey RENAME TO {TABLE}_pkey"))
+        await session.exec(text(f"ALTER SEQUENCE {REBUILD_TABLE}_id_seq RENAME TO {TABLE}_id_seq"))
+        for index in ProductStore.__table__.indexes:
+            await session.exec(text(f"ALTER INDEX {index.name.replace(TABLE, REBUILD_TABLE)} RENAME TO {index.name}"))
+        await session.exec(text(f"SELECT setval('{TABLE}_id_seq', GREATEST((SELECT max(id) FROM {TABLE}), :last_id, 1))"),
+                           params={"last_id": last_id})
+
+        catch_up = {tp: stored[tp] for tp in end if stored.get(tp, 0) > end[tp]}
+        caught_up = 0
+        async for records in read_events(consumer, {tp: end[tp] for tp in catch_up}, catch_up):
+            await apply_products(session, decode(records))
+            caught_up += len(records)
+        await save_offsets(session, KAFKA_PRODUCT_CONSUMER_GROUP_ID,
+                           {tp: max(offset, stored.get(tp, 0)) for tp, offset in end.items()})
+        await session.commit()
+    logger.info(f"Replaced {TABLE}, applied {caught_up} event(s) consumed during the rebuild")
+
+@asynccontextmanager
+async def rebuild_lock():
+    # One rebuild at a time across all processes, concurrent ones would race on the rebuild table
+    # and the swap. The session-level lock lives on a connection of its own for the whole rebuild,
+    # it is released if the process dies.
+    async with engine.connect() as connection:
+        await connection.execute(text("SELECT pg_advisory_lock(hashtext(:name))"), {"name": LOCK_NAME})
+        await connection.commit()
+        try:
+            yield
+        finally:
+            await connection.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"), {"name": LOCK_NAME})
+            await connection.commit()
+
+async def rebuild(snapshot: str | None = None, write_snapshot_path: str | None = None,
+                  from_state: bool = False, publish_state: bool = False):
+    async with rebuild_lock():
+        await _rebuild(snapshot, write_snapshot_path, from_state, publish_state)
+
+async def _rebuild(snapshot: str | None = None, write_snapshot_path: str | None = None,
+                   from_state: bool = False, publish_state: bool = False):
+    await create_tables()
+    ids, last_id = await load_ids()
+    catalog = Catalog(ids)
+    snapshot_offsets = {}
+    if snapshot or from_state:
+        rows, snapshot_offsets = read_snapshot(snapshot) if snapshot else await read_states()
+        catalog.load(rows)
+        last_id = max([last_id, *catalog.ids.values()])
+
+    consumer = AIOKafkaConsumer(bootstrap_servers=BOOTSTRAP_SERVER, group_id=None, enable_auto_commit=False)
+    await consumer.start()
+    try:
+        await consumer.topics()
+        partitions = [TopicPartition(KAFKA_PRODUCT_TOPIC, partition)
+                      for partition in consumer.partitions_for_topic(KAFKA_PRODUCT_TOPIC) or ()]
+        consumer.assign(partitions)
+        beginning = await consumer.beginning_offsets(partitions)
+        end = await consumer.end_offsets(partitions)
+        start = {tp: max(beginning[tp], snapshot_offsets.get(tp.partition, 0)) for tp in partitions}
+
+        async for records in read_events(consumer, start, end):
+            for product in decode(records):
+                catalog.apply(product)
+            if catalog.events % 100_000 < len(records):
+                logger.info(f"Folded {catalog.events} events into {len(catalog.products)} products")
+        logger.info(f"Folded {catalog.events} events into {len(catalog.products)} products, "
+                    f"{catalog.skipped} event(s) skipped")
+
+        await load_table(catalog, last_id)
+        if write_snapshot_path:
+            write_snapshot(write_snapshot_path, catalog, end)
+        await swap_tables(consumer, end)
+    finally:
+        await consumer.stop()
+
+    if publish_state:
+        producer = await create_producer()
+        if not producer:
+            raise Exception("Failed to create kafka producer for the product state")
+        try:
+            async with AsyncSession(engine) as session:
+                await publish_catalog(producer, session)
+        finally:
+            await stop_producer(producer)
+
+async def has_stored_offsets() -> bool:
+    async with AsyncSession(engine) as session:
+        statement = select(ConsumerOffset).where(ConsumerOffset.group_id == KAFKA_PRODUCT_CONSUMER_GROUP_ID)
+        return (await session.exec(statement)).first() is not None
+
+async def bootstrap():
+    # Before the consumers start: a consumer group that has not stored any offsets yet loads the
+    # catalog from the state topic or a snapshot, instead of replaying the whole event history.
+    # Replicas starting together wait for the first one's rebuild and then find its offsets.
+    if not KAFKA_PRODUCT_BOOTSTRAP:
+        return
+    await create_tables()
+    if await has_stored_offsets():
+        return
+    async with rebuild_lock():
+        if await has_stored_offsets():
+            return
+        from_state = KAFKA_PRODUCT_BOOTSTRAP == "state"
+        logger.info(f"Bootstrapping {TABLE} from {'the state topic' if from_state else KAFKA_PRODUCT_BOOTSTRAP}")
+        await _rebuild(snapshot=None if from_state else KAFKA_PRODUCT_BOOTSTRAP, from_state=from_state)
+
+async def run(task: Awaitable[None]):
+    try:
+        await task
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Rebuild {TABLE} from {KAFKA_PRODUCT_TOPIC}")
+    parser.add_argument("--snapshot", help="start from a snapshot file instead of the earliest offset")
+    parser.add_argument("--write-snapshot", help="save the folded state and offsets to this file")
+    parser.add_argument("--from-state", action="store_true", help="start from the product state topic")
+    parser.add_argument("--publish-state", action="store_true",
+                        help="publish every product to the state topic afterwards, e.g. when enabling it")
+    args = parser.parse_args()
+    asyncio.run(run(rebuild(args.snapshot, args.write_snapshot, args.from_state, args.publish_state)))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,4 +16,44 @@ KAFKA_PRODUCT_CONSUMER_GROUP_ID = config("KAFKA_PRODUCT_CONSUMER_GROUP_ID", cast
 KAFKA_PRODUCT_CONFIRMATION_TOPIC = config("KAFKA_PRODUCT_CONFIRMATION_TOPIC", cast=str)
 
 DATABASE_URL = config("DATABASE_URL", cast=Secret)
-TEST_DATABASE_URL = config("TEST_DATABASE_URL", cast=Secret)
\ No newline at end of file
+TEST_DATABASE_URL = config("TEST_DATABASE_URL", cast=Secret)
+
+# The consumer applies up to KAFKA_CONSUMER_BATCH_SIZE records, or whatever arrived within
+# KAFKA_CONSUMER_BATCH_TIMEOUT_MS, in a single database transaction
+KAFKA_CONSUMER_BATCH_SIZE = config("KAFKA_CONSUMER_BATCH_SIZE", cast=int, default=500)
+KAFKA_CONSUMER_BATCH_TIMEOUT_MS = config("KAFKA_CONSUMER_BATCH_TIMEOUT_MS", cast=int, default=200)
+
+# Number of consumer tasks per process. Each one joins the consumer group and owns a share of the
+# topic partitions, workers beyond the partition count stay idle.
+KAFKA_CONSUMER_WORKERS = config("KAFKA_CONSUMER_WORKERS", cast=int, default=1)
+
+# In-process cache of GET /products/{id} responses, kept up to date by the consumer.
+# With several product_db processes a process only sees its own partitions' writes,
+# entries written elsewhere expire after the TTL.
+PRODUCT_CACHE_MAX_BYTES = config("PRODUCT_CACHE_MAX_BYTES", cast=int, default=64 * 1024 * 1024)
+PRODUCT_CACHE_TTL_SECONDS = config("PRODUCT_CACHE_TTL_SECONDS", cast=float, default=300)
+
+# Callers are authenticated with access tokens issued by user_svc, verified locally against its
+# published key set. Keys are cached for JWKS_CACHE_SECONDS, an unknown kid triggers a refetch.
+# Authentication is disabled while JWKS_URL is empty (e.g. http://user_svc:8000/.well-known/jwks.json).
+JWKS_URL = config("JWKS_URL", cast=str, default="")
+JWKS_CACHE_SECONDS = config("JWKS_CACHE_SECONDS", cast=float, default=300)
+
+# Transient database and broker errors (lost connections, timeouts, retriable Kafka errors) are
+# retried up to CONSUMER_MAX_RETRIES times with exponential backoff starting at
+# CONSUMER_RETRY_BACKOFF_MS. Events that the database rejects, can't be decoded or update a missing
+# product go to the dead-letter topic with the original payload, they can be replayed with
+# "python -m product_db.dead_letters". Other Kafka errors stop the batch until they are resolved.
+CONSUMER_MAX_RETRIES = config("CONSUMER_MAX_RETRIES", cast=int, default=5)
+CONSUMER_RETRY_BACKOFF_MS = config("CONSUMER_RETRY_BACKOFF_MS", cast=int, default=500)
+CONSUMER_RETRY_MAX_BACKOFF_MS = config("CONSUMER_RETRY_MAX_BACKOFF_MS", cast=int, default=30000)
+KAFKA_PRODUCT_DEAD_LETTER_TOPIC = config("KAFKA_PRODUCT_DEAD_LETTER_TOPIC", cast=str,
+                                         default=f"{KAFKA_PRODUCT_TOPIC}.dead_letter")
+
+# Latest state of every product, published by the consumer to a log-compacted topic (created by
+# product_svc) after each batch; an empty name disables it. A consumer group without stored
+# offsets first loads the catalog from KAFKA_PRODUCT_BOOTSTRAP: "state" for that topic, or the
+# path of a snapshot written by "python -m product_db.rebuild --write-snapshot". Empty replays
+# the whole event history instead.
+KAFKA_PRODUCT_STATE_TOPIC = config("KAFKA_PRODUCT_STATE_TOPIC", cast=str, default=f"{KAFKA_PRODUCT_TOPIC}.state")
+KAFKA_PRODUCT_BOOTSTRAP = config("KAFKA_PRODUCT_BOOTSTRAP", cast=str, default="")
@@ -0,0 +1,127 @@
+# Latest state of every product on the log-compacted KAFKA_PRODUCT_STATE_TOPIC, keyed by product_id.
+# The consumer publishes the stored row after applying a batch and a tombstone (no value) for a
+# deleted product; compaction keeps only the last record per product, so reading the topic costs
+# the size of the catalog, not the length of its history.
+# Every record carries the event partition and offset it reflects. A consumer starting from the
+# state continues with the events after the highest offset seen per partition.
+import json
+import logging
+from typing import Any, Iterable
+
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRecord, TopicPartition
+from product_db.crud import PRODUCT_FIELDS
+from product_db.models import ConsumerOffset, ProductStore
+from product_db.settings import (BOOTSTRAP_SERVER, KAFKA_CONSUMER_BATCH_SIZE, KAFKA_PRODUCT_CONSUMER_GROUP_ID,
+                                 KAFKA_PRODUCT_STATE_TOPIC, KAFKA_PRODUCT_TOPIC)
+from sqlalchemy import or_, text
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+SOURCE_PARTITION_HEADER = "source.partition"
+SOURCE_OFFSET_HEADER = "source.offset"
+POLL_TIMEOUT_MS = 1000
+
+
+def source_headers(partition: int, offset: int) -> list[tuple[str, bytes]]:
+    return [(SOURCE_PARTITION_HEADER, str(partition).encode('utf-8')),
+            (SOURCE_OFFSET_HEADER, str(offset).encode('utf-8'))]
+
+def encode_state(row: dict[str, Any]) -> bytes:
+    return json.dumps({field: row.get(field) for field in ("id", *PRODUCT_FIELDS)}).encode('utf-8')
+
+async def send_states(producer: AIOKafkaProducer, states: Iterable[tuple[str, dict[str, Any] | None, list]]):
+    # (product_id, row or None for a tombstone, headers). All records are handed to the producer
+    # first and awaited together, so they share request batches.
+    deliveries = []
+    for product_id, row, headers in states:
+        deliveries.append(await producer.send(KAFKA_PRODUCT_STATE_TOPIC,
+                                              encode_state(row) if row is not None else None,
+                                              key=product_id.encode('utf-8'), headers=headers))
+    for delivery in deliveries:
+        await delivery
+
+async def publish_states(producer: AIOKafkaProducer, session: AsyncSession,
+                         products: list[tuple[ConsumerRecord, dict[str, Any]]], changed: set[int]):
+    # Called inside the consumer's transaction before it commits, so a failed publish rolls the
+    # batch back and the state topic never misses a committed change. Reads the rows as the
+    # transaction sees them: the products named by the events and every changed row.
+    sources = {}
+    for msg, product in products:
+        if product.get("product_id") is not None:
+            sources[product["product_id"]] = msg
+    if not sources and not changed:
+        return
+    statement = select(ProductStore).where(or_(col(ProductStore.product_id).in_(sources.keys()),
+                                               col(ProductStore.id).in_(changed)))
+    rows = {row.product_id: row.model_dump() for row in await session.exec(statement)}
+
+    states = []
+    last = products[-1][0]
+    for product_id in sources.keys() | rows.keys():
+        # Rows changed by legacy events addressed by id have no source of their own
+        msg = sources.get(product_id, last)
+        states.append((product_id, rows.get(product_id), source_headers(msg.partition, msg.offset)))
+    await send_states(producer, states)
+
+async def publish_catalog(producer: AIOKafkaProducer, session: AsyncSession):
+    # Publishes every stored product, e.g. when the state topic is introduced. Consumers are held
+    # back for the duration (readers are not), so no newer state published by them is overwritten
+    # and the stored offsets match the rows. Each record claims the offsets of one partition in turn.
+    await session.exec(text(f"LOCK TABLE {ProductStore.__tablename__} IN SHARE MODE"))
+    statement = select(ConsumerOffset).where(ConsumerOffset.group_id == KAFKA_PRODUCT_CONSUMER_GROUP_ID,
+                                             ConsumerOffset.topic == KAFKA_PRODUCT_TOPIC,
+                                             col(ConsumerOffset.offset) > 0)
+    sources = [source_headers(row.partition, row.offset - 1) for row in await session.exec(statement)] or [[]]
+    published = 0
+    result = await session.stream(select(ProductStore).execution_options(yield_per=KAFKA_CONSUMER_BATCH_SIZE))
+    async for rows in result.scalars().partitions():
+        await send_states(producer, [(row.product_id, row.model_dump(), sources[(published + i) % len(sources)])
+                                     for i, row in enumerate(rows)])
+        published += len(rows)
+    await session.commit()
+    logger.info(f"Published {published} products to {KAFKA_PRODUCT_STATE_TOPIC}")
+
+async def read_states() -> tuple[dict[str, dict[str, Any]], dict[int, int]]:
+    # Reads the state topic up to the end offsets seen at start. Returns the rows by product_id
+    # and, per event partition, the next event offset the rows do not reflect yet.
+    consumer = AIOKafkaConsumer(bootstrap_servers=BOOTSTRAP_SERVER, group_id=None, enable_auto_commit=False)
+    await consumer.start()
+    rows: dict[str, dict[str, Any]] = {}
+    offsets: dict[int, int] = {}
+    try:
+        await consumer.topics()
+        partitions = [TopicPartition(KAFKA_PRODUCT_STATE_TOPIC, partition)
+                      for partition in consumer.partitions_for_topic(KAFKA_PRODUCT_STATE_TOPIC) or ()]
+        if not partitions:
+            logger.warning(f"Topic {KAFKA_PRODUCT_STATE_TOPIC} does not exist, starting without state")
+            return rows, offsets
+        consumer.assign(partitions)
+        await consumer.seek_to_beginning(*partitions)
+        end = await consumer.end_offsets(partitions)
+        remaining = {tp for tp in partitions if await consumer.position(tp) < end[tp]}
+        while remaining:
+            batches = await consumer.getmany(*remaining, timeout_ms=POLL_TIMEOUT_MS,
+                                             max_records=KAFKA_CONSUMER_BATCH_SIZE)
+            for tp, records in batches.items():
+                for msg in records:
+                    if msg.offset >= end[tp]:
+                        break
+                    product_id = msg.key.decode('utf-8')
+                    if msg.value is None:
+                        rows.pop(product_id, None)
+                    else:
+                        rows[product_id] = json.loads(msg.value)
+                    headers = dict(msg.headers or ())
+                    if SOURCE_PARTITION_HEADER in headers:
+                        partition = int(headers[SOURCE_PARTITION_HEADER])
+                        offsets[partition] = max(offsets.get(partition, 0), int(headers[SOURCE_OFFSET_HEADER]) + 1)
+            for tp in list(remaining):
+                if await consumer.position(tp) >= end[tp]:
+                    remaining.discard(tp)
+    finally:
+        await consumer.stop()
+    logger.info(f"Read {len(rows)} products from {KAFKA_PRODUCT_STATE_TOPIC}")
+    return rows, offsets
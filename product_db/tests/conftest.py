@@ -0,0 +1,11 @@
+import os
+
+from starlette.config import Config
+
+# The service builds its engine from DATABASE_URL on import, point it at the test database first
+try:
+    config = Config(".env")
+except FileNotFoundError:
+    config = Config()
+
+os.environ["DATABASE_URL"] = str(config("TEST_DATABASE_URL"))
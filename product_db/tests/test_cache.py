@@ -0,0 +1,115 @@
+import pytest
+from product_db import cache
+from product_db.cache import ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_entry_expires_after_the_ttl(clock):
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    product_cache.put(1, b"one", product_cache.generation)
+
+    clock.now += 10
+    assert product_cache.get(1) == b"one"
+    clock.now += 0.1
+    assert product_cache.get(1) is None
+    assert product_cache.stats()["entries"] == 0
+    assert product_cache.size == 0
+
+def test_least_recently_used_entry_is_evicted_first(clock):
+    product_cache = ResponseCache(max_bytes=6, ttl_seconds=10)
+    product_cache.put(1, b"aa", product_cache.generation)
+    product_cache.put(2, b"bb", product_cache.generation)
+    product_cache.put(3, b"cc", product_cache.generation)
+    assert product_cache.get(1) == b"aa"
+
+    product_cache.put(4, b"dd", product_cache.generation)
+
+    assert product_cache.get(2) is None
+    assert [product_cache.get(key) for key in (1, 3, 4)] == [b"aa", b"cc", b"dd"]
+    assert product_cache.size == 6
+    assert product_cache.evictions == 1
+
+def test_replacing_an_entry_keeps_the_size_accurate(clock):
+    product_cache = ResponseCache(max_bytes=10, ttl_seconds=10)
+    product_cache.put(1, b"12345", product_cache.generation)
+    product_cache.put(1, b"123", product_cache.generation)
+
+    assert product_cache.size == 3
+    assert product_cache.get(1) == b"123"
+
+def test_value_larger_than_the_budget_is_not_stored(clock):
+    product_cache = ResponseCache(max_bytes=4, ttl_seconds=10)
+    product_cache.put(1, b"ab", product_cache.generation)
+    product_cache.put(2, b"abcde", product_cache.generation)
+
+    assert product_cache.get(1) == b"ab"
+    assert product_cache.get(2) is None
+
+def test_read_racing_with_an_invalidation_is_not_stored(clock):
+    # A reader takes the generation, the consumer then applies a write to the same product
+    # before the reader stores the row it read from the database
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    generation = product_cache.generation
+    product_cache.invalidate([1])
+    product_cache.put(1, b"outdated", generation)
+
+    assert product_cache.get(1) is None
+
+def test_invalidation_of_another_product_also_discards_the_racing_read(clock):
+    # The generation is global, so any write in between drops the value instead of risking it
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    generation = product_cache.generation
+    product_cache.invalidate([2])
+    product_cache.put(1, b"maybe outdated", generation)
+
+    assert product_cache.get(1) is None
+    product_cache.put(1, b"fresh", product_cache.generation)
+    assert product_cache.get(1) == b"fresh"
+
+def test_invalidate_removes_only_the_changed_entries(clock):
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    product_cache.put(1, b"one", product_cache.generation)
+    product_cache.put(2, b"two", product_cache.generation)
+
+    product_cache.invalidate([1, 3])
+
+    assert product_cache.get(1) is None
+    assert product_cache.get(2) == b"two"
+    assert product_cache.invalidations == 1
+    assert product_cache.size == 3
+
+def test_clear_discards_reads_started_before_it(clock):
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    product_cache.put(1, b"one", product_cache.generation)
+    generation = product_cache.generation
+
+    product_cache.clear()
+    product_cache.put(2, b"two", generation)
+
+    assert product_cache.get(1) is None
+    assert product_cache.get(2) is None
+    assert product_cache.size == 0
+
+def test_stats_count_hits_and_misses(clock):
+    product_cache = ResponseCache(max_bytes=100, ttl_seconds=10)
+    assert product_cache.stats()["hit_rate"] == 0.0
+    product_cache.put(1, b"one", product_cache.generation)
+    product_cache.get(1)
+    product_cache.get(2)
+
+    stats = product_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
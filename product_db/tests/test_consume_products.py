@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+from aiokafka import ConsumerRecord, TopicPartition
+from aiokafka.errors import (KafkaConnectionError, KafkaTimeoutError, MessageSizeTooLargeError, NotLeaderForPartitionError,
+                             TopicAuthorizationFailedError)
+from sqlalchemy.exc import OperationalError
+from product_db.consumers import consume_products
+from product_db.consumers.consume_products import (BatchLock, PartitionsRevoked, dead_letter, is_data_error, is_transient,
+                                                   with_retries)
+
+
+class RecordingProducer:
+    def __init__(self):
+        self.sent = []
+
+    async def send_and_wait(self, topic, value, key=None, headers=None, **kwargs):
+        self.sent.append((topic, value, key))
+
+
+class StopConsuming(Exception):
+    pass
+
+
+class RebalancingConsumer:
+    # Partition products[0], stored offset 5. The second fetch of the first batch runs a rebalance
+    # that keeps the partition, as Kafka does while another worker joins the group.
+    def __init__(self, rebalance_listener):
+        self.listener = rebalance_listener(self)
+        self.tp = TopicPartition("products", 0)
+        self.position = 5
+        self.fetches = 0
+        self.seeks = []
+
+    def assignment(self):
+        return {self.tp}
+
+    def highwater(self, tp):
+        return None
+
+    def seek(self, tp, offset):
+        self.seeks.append(offset)
+        self.position = offset
+
+    async def fetch(self, count: int) -> dict:
+        records = [record(offset) for offset in range(self.position, self.position + count)]
+        self.position += count
+        return {self.tp: records}
+
+    async def getmany(self, timeout_ms: int, max_records: int) -> dict:
+        self.fetches += 1
+        if self.fetches == 1:
+            return await self.fetch(2)
+        if self.fetches == 2:
+            await self.listener.on_partitions_revoked({self.tp})
+            await self.listener.on_partitions_assigned({self.tp})
+            return await self.fetch(3)
+        raise StopConsuming()
+
+    async def stop(self):
+        pass
+
+
+def record(offset: int) -> ConsumerRecord:
+    return ConsumerRecord(topic="products", partition=0, offset=offset, timestamp=0, timestamp_type=0,
+                          key=b"abc", value=b"not a product", checksum=None, serialized_key_size=3,
+                          serialized_value_size=13, headers=())
+
+
+def test_revocation_does_not_wait_for_the_retry_backoff(monkeypatch):
+    monkeypatch.setattr(consume_products, "CONSUMER_RETRY_BACKOFF_MS", 10_000)
+    monkeypatch.setattr(consume_products, "CONSUMER_RETRY_MAX_BACKOFF_MS", 10_000)
+
+    async def run():
+        batch_lock = BatchLock()
+        attempts = []
+
+        async def store():
+            attempts.append(batch_lock.lock.locked())
+            raise OperationalError("statement", {}, ConnectionError("connection lost"))
+
+        retrying = asyncio.create_task(with_retries(lambda: batch_lock.run(0, store), "storing"))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(batch_lock.revoke(), timeout=1)
+        retrying.cancel()
+        return attempts
+
+    assert asyncio.run(run()) == [True]
+
+def test_batch_fetched_before_a_revocation_is_refused():
+    async def run():
+        batch_lock = BatchLock()
+        generation = batch_lock.generation
+        await batch_lock.revoke()
+        with pytest.raises(PartitionsRevoked):
+            await batch_lock.run(generation, lambda: asyncio.sleep(0))
+        await batch_lock.run(batch_lock.generation, lambda: asyncio.sleep(0))
+
+    asyncio.run(run())
+
+def test_dead_letters_are_published_once_per_record():
+    async def run():
+        producer = RecordingProducer()
+        dead_lettered: set[tuple[str, int, int]] = set()
+        for msg in (record(1), record(1), record(2)):
+            await dead_letter(producer, msg, "Undecodable", dead_lettered)
+        return producer.sent
+
+    assert len(asyncio.run(run())) == 2
+
+def test_batch_spanning_a_rebalance_resumes_from_the_stored_offsets(monkeypatch):
+    consumers = []
+
+    async def create_consumer(topic, group_id, enable_auto_commit, rebalance_listener):
+        consumers.append(RebalancingConsumer(rebalance_listener))
+        return consumers[0]
+
+    async def create_producer():
+        return RecordingProducer()
+
+    async def stop_producer(producer):
+        pass
+
+    async def load_offsets(session, group_id, partitions):
+        return {tp: 5 for tp in partitions}
+
+    monkeypatch.setattr(consume_products, "KAFKA_CONSUMER_BATCH_SIZE", 5)
+    monkeypatch.setattr(consume_products, "create_consumer", create_consumer)
+    monkeypatch.setattr(consume_products, "create_producer", create_producer)
+    monkeypatch.setattr(consume_products, "stop_producer", stop_producer)
+    monkeypatch.setattr(consume_products, "load_offsets", load_offsets)
+
+    with pytest.raises(StopConsuming):
+        asyncio.run(consume_products.consume_products())
+
+    # The batch held offsets 5-6 from before and 5-7 from after the rebalance and was dropped,
+    # the next fetch starts at the stored offset again instead of 8
+    consumer = consumers[0]
+    assert consumer.seeks[-1] == 5
+    assert consumer.position == 5
+
+@pytest.mark.parametrize("error, transient, data", [
+    (OperationalError("statement", {}, ConnectionError("connection lost")), True, False),
+    (KafkaTimeoutError(), True, False),
+    (KafkaConnectionError("broker down"), True, False),
+    (NotLeaderForPartitionError(), True, False),
+    (TopicAuthorizationFailedError(), False, False),
+    (MessageSizeTooLargeError(), False, True),
+    (PartitionsRevoked(), False, False),
+    (ValueError("price must be a number"), False, True),
+])
+def test_only_data_errors_are_dead_lettered(error, transient, data):
+    assert is_transient(error) == transient
+    assert is_data_error(error) == data
+
+def test_broker_failures_do_not_dead_letter_the_batch(monkeypatch):
+    producer = RecordingProducer()
+
+    async def apply_events(products, offsets, producer, dead_lettered):
+        raise KafkaConnectionError("state topic unavailable")
+
+    monkeypatch.setattr(consume_products, "apply_events", apply_events)
+    monkeypatch.setattr(consume_products, "CONSUMER_MAX_RETRIES", 0)
+    monkeypatch.setattr(consume_products, "decode_product", lambda value: {"operation": "CREATE"})
+
+    with pytest.raises(KafkaConnectionError):
+        asyncio.run(consume_products.store_products([record(1), record(2)], producer, BatchLock(), 0, set()))
+    assert producer.sent == []
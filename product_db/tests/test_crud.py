@@ -0,0 +1,58 @@
+import asyncio
+import uuid
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from product_db.crud import apply_products
+from product_db.db import create_tables, engine
+from product_db.models import ProductStore
+
+
+def event(operation: str, product_id: str, **fields) -> dict:
+    return {"operation": operation, "product_id": product_id, **fields}
+
+def create(product_id: str, name: str = "name") -> dict:
+    return event("CREATE", product_id, name=name, description="description", price=1.0, category="category")
+
+def apply(products: list[dict]) -> tuple[ProductStore | None, list[dict]]:
+    # Applies one batch and returns the stored row, the transaction is rolled back afterwards
+    async def run():
+        await create_tables()
+        missing: list[dict] = []
+        try:
+            async with AsyncSession(engine) as session:
+                await apply_products(session, products, missing)
+                statement = select(ProductStore).where(ProductStore.product_id == products[0]["product_id"])
+                row = (await session.exec(statement)).first()
+                await session.rollback()
+                return row, missing
+        finally:
+            # Pooled connections belong to this event loop
+            await engine.dispose()
+    return asyncio.run(run())
+
+
+def test_create_update_delete_in_one_batch():
+    product_id = uuid.uuid4().hex
+    row, missing = apply([create(product_id), event("UPDATE", product_id, price=2.0), event("DELETE", product_id)])
+    assert row is None
+    assert missing == []
+
+def test_update_after_create_in_one_batch():
+    product_id = uuid.uuid4().hex
+    row, missing = apply([create(product_id), event("UPDATE", product_id, price=2.0),
+                          event("UPDATE", product_id, name="renamed")])
+    assert (row.name, row.price) == ("renamed", 2.0)
+    assert missing == []
+
+def test_create_after_delete_in_one_batch():
+    product_id = uuid.uuid4().hex
+    row, _ = apply([create(product_id, "first"), event("DELETE", product_id), create(product_id, "second")])
+    assert row.name == "second"
+
+def test_update_before_create_is_missing():
+    product_id = uuid.uuid4().hex
+    update = event("UPDATE", product_id, price=2.0)
+    row, missing = apply([update, create(product_id)])
+    assert row.price == 1.0
+    assert missing == [update]
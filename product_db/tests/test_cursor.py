@@ -0,0 +1,44 @@
+import pytest
+from sqlmodel import col
+from product_db.crud import format_cursor, parse_cursor, search_products
+from product_db.models import ProductStore
+
+
+BY_ID = [col(ProductStore.id)]
+BY_PRICE = [col(ProductStore.price), col(ProductStore.id)]
+
+
+@pytest.mark.parametrize("row, order", [
+    ({"id": 42}, BY_ID),
+    ({"price": 19.99, "id": 7}, BY_PRICE),
+    ({"price": 0.1 + 0.2, "id": 1}, BY_PRICE),
+    ({"price": 1e-7, "id": 3}, BY_PRICE),
+    ({"price": -2.5, "id": 9}, BY_PRICE),
+])
+def test_cursor_round_trip(row, order):
+    # The price must come back exactly, or the next page would repeat or skip rows
+    assert parse_cursor(format_cursor(row, order), order) == [row[column.name] for column in order]
+
+@pytest.mark.parametrize("cursor, order", [
+    ("", BY_ID),
+    ("abc", BY_ID),
+    ("1.5", BY_ID),
+    ("1:2", BY_ID),
+    ("5", BY_PRICE),
+    ("1.5:", BY_PRICE),
+    (":3", BY_PRICE),
+    ("1.5:2:3", BY_PRICE),
+    ("cheap:3", BY_PRICE),
+    ("nan:3", BY_PRICE),
+    ("inf:3", BY_PRICE),
+    ("1e999:3", BY_PRICE),
+])
+def test_malformed_cursor_is_rejected(cursor, order):
+    with pytest.raises(ValueError):
+        parse_cursor(cursor, order)
+
+def test_cursor_of_another_ordering_is_rejected():
+    # A cursor from an id ordered page cannot continue a price ordered search
+    cursor = format_cursor({"id": 42}, BY_ID)
+    with pytest.raises(ValueError):
+        search_products(BY_ID, min_price=1.0, cursor=cursor)
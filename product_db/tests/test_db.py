@@ -0,0 +1,35 @@
+import asyncio
+
+from sqlalchemy import insert, inspect, select, text
+from product_db.db import _create_tables, create_tables, engine
+from product_db.models import ProductStore
+
+
+def test_duplicate_products_are_removed_before_the_unique_index_is_built():
+    # A database from before product_id was unique, recreated inside a transaction that is rolled back
+    def check(connection):
+        table = ProductStore.__table__
+        connection.execute(text("DROP INDEX ix_productstore_product_id"))
+        rows = [{"product_id": product_id, "name": name, "description": "d", "price": 1.0, "category": "c"}
+                for product_id, name in (("dup", "old"), ("dup", "new"), ("single", "only"))]
+        connection.execute(insert(table), rows)
+
+        _create_tables(connection)
+
+        stored = connection.execute(select(table.c.product_id, table.c.name)
+                                    .where(table.c.product_id.in_(["dup", "single"]))).all()
+        assert sorted(stored) == [("dup", "new"), ("single", "only")]
+        indexes = inspect(connection).get_indexes(table.name)
+        assert any(index["unique"] and index["column_names"] == ["product_id"] for index in indexes)
+
+    async def run():
+        await create_tables()
+        try:
+            async with engine.connect() as connection:
+                async with connection.begin() as transaction:
+                    await connection.run_sync(check)
+                    await transaction.rollback()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from aiokafka import ConsumerRecord, TopicPartition
+from aiokafka.errors import KafkaTimeoutError
+from product_db import dead_letters
+from product_db.settings import KAFKA_PRODUCT_DEAD_LETTER_TOPIC
+
+TP = TopicPartition(KAFKA_PRODUCT_DEAD_LETTER_TOPIC, 0)
+
+
+class DeadLetterConsumer:
+    # Two dead letters in partition 0 of the dead-letter topic
+    instances = []
+
+    def __init__(self, **config):
+        self.position_ = 0
+        self.committed = []
+        self.stopped = False
+        DeadLetterConsumer.instances.append(self)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.stopped = True
+
+    async def topics(self):
+        return {TP.topic}
+
+    def partitions_for_topic(self, topic):
+        return {0}
+
+    def assign(self, partitions):
+        pass
+
+    async def end_offsets(self, partitions):
+        return {TP: 2}
+
+    async def position(self, tp):
+        return self.position_
+
+    async def getmany(self, *partitions, timeout_ms):
+        records = [ConsumerRecord(topic=TP.topic, partition=0, offset=offset, timestamp=0, timestamp_type=0,
+                                  key=b"abc", value=b"event", checksum=None, serialized_key_size=3,
+                                  serialized_value_size=5, headers=[("dead_letter.topic", b"products")])
+                   for offset in range(self.position_, 2)]
+        self.position_ = 2
+        return {TP: records}
+
+    async def commit(self, offsets):
+        self.committed.append(offsets)
+
+
+class FailingProducer:
+    # Accepts the messages, the delivery of the second one fails
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, topic, value, key=None, headers=None):
+        self.sent += 1
+        delivery = asyncio.get_running_loop().create_future()
+        if self.sent == 2:
+            delivery.set_exception(KafkaTimeoutError())
+        else:
+            delivery.set_result(None)
+        return delivery
+
+    async def flush(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+@pytest.fixture
+def consumers(monkeypatch):
+    DeadLetterConsumer.instances = []
+    monkeypatch.setattr(dead_letters, "AIOKafkaConsumer", DeadLetterConsumer)
+    return DeadLetterConsumer.instances
+
+
+def test_undelivered_dead_letters_are_not_committed(monkeypatch, consumers):
+    async def create_producer():
+        return FailingProducer()
+
+    monkeypatch.setattr(dead_letters, "create_producer", create_producer)
+    with pytest.raises(KafkaTimeoutError):
+        asyncio.run(dead_letters.replay())
+    assert consumers[0].committed == []
+
+def test_replay_aborts_without_producer(monkeypatch, consumers):
+    async def create_producer():
+        return None
+
+    monkeypatch.setattr(dead_letters, "create_producer", create_producer)
+    with pytest.raises(Exception, match="no dead letters were replayed"):
+        asyncio.run(dead_letters.replay())
+    assert consumers[0].committed == [] and consumers[0].stopped
+
+def test_dry_run_commits_nothing(consumers):
+    assert asyncio.run(dead_letters.replay(dry_run=True)) == 2
+    assert consumers[0].committed == []
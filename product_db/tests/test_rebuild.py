@@ -0,0 +1,30 @@
+import asyncio
+
+from product_db import rebuild
+from product_db.db import engine
+
+
+def test_concurrent_bootstraps_rebuild_once(monkeypatch):
+    rebuilds = []
+
+    async def has_stored_offsets():
+        return bool(rebuilds)
+
+    async def _rebuild(**kwargs):
+        # The second replica must not start while the first one is still rebuilding
+        assert not rebuilds
+        await asyncio.sleep(0.2)
+        rebuilds.append(kwargs)
+
+    monkeypatch.setattr(rebuild, "KAFKA_PRODUCT_BOOTSTRAP", "state")
+    monkeypatch.setattr(rebuild, "has_stored_offsets", has_stored_offsets)
+    monkeypatch.setattr(rebuild, "_rebuild", _rebuild)
+
+    async def run():
+        try:
+            await asyncio.gather(rebuild.bootstrap(), rebuild.bootstrap())
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+    assert rebuilds == [{"snapshot": None, "from_state": True}]
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Annotated, Any
+
+import httpx
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jose import jwk, jwt, JWTError
+from product_svc.settings import JWKS_CACHE_SECONDS, JWKS_URL
+
+# Both product services carry this module, each service image is built from its own directory and
+# can't import the other's code. tests/test_auth.py keeps the two copies identical.
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = ["ES256", "RS256"]
+# A token with an unknown kid refetches the key set at most this often
+MIN_REFRESH_INTERVAL = 30
+FETCH_TIMEOUT = 5
+
+
+class JWKSVerifier:
+    # Verifies user_svc access tokens with the public keys of its JWKS endpoint. The keys are
+    # cached, so verifying a token is a signature check without a call to user_svc.
+    def __init__(self, url: str, cache_seconds: float):
+        self.url = url
+        self.cache_seconds = cache_seconds
+        self.keys: dict[str, Any] = {}
+        self.fetched_at = float("-inf")
+        self.lock = asyncio.Lock()
+
+    async def refresh(self, min_age: float):
+        async with self.lock:
+            # Another request may have refreshed the keys while this one waited for the lock
+            if time.monotonic() - self.fetched_at < min_age:
+                return
+            try:
+                async with httpx.AsyncClient(timeout=FETCH_TIMEOUT) as client:
+                    response = await client.get(self.url)
+                    response.raise_for_status()
+                self.keys = {key["kid"]: jwk.construct(key, key.get("alg"))
+                             for key in response.json()["keys"] if key.get("kid")}
+                logger.info(f"Loaded {len(self.keys)} signing key(s) from {self.url}")
+            except Exception as e:
+                # Keep the cached keys, tokens signed with them can still be verified
+                logger.error(f"Failed to fetch signing keys from {self.url}: {e}")
+            self.fetched_at = time.monotonic()
+
+    async def get_key(self, kid: str | None) -> Any:
+        if time.monotonic() - self.fetched_at >= self.cache_seconds:
+            await self.refresh(self.cache_seconds)
+        if kid not in self.keys:
+            # The key may have been rotated in after the last fetch
+            await self.refresh(MIN_REFRESH_INTERVAL)
+        return self.keys.get(kid)
+
+    async def verify(self, token: str) -> dict[str, Any]:
+        key = await self.get_key(jwt.get_unverified_header(token).get("kid"))
+        if key is None:
+            raise JWTError("Unknown signing key")
+        payload = jwt.decode(token, key, algorithms=ALGORITHMS)
+        if payload.get("type") != "access":
+            raise JWTError("Expected access token")
+        return payload
+
+
+verifier = JWKSVerifier(JWKS_URL, JWKS_CACHE_SECONDS) if JWKS_URL else None
+bearer_scheme = HTTPBearer(auto_error=False)
+
+async def authenticated_user(
+        credentials: Annotated[HTTPAuthorizationCredentials | None, Depends(bearer_scheme)]
+) -> str | None:
+    # Username of the caller, None while authentication is disabled
+    if verifier is None:
+        return None
+    credential_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid token, Please login again",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+    if credentials is None:
+        raise credential_exception
+    try:
+        payload = await verifier.verify(credentials.credentials)
+    except JWTError:
+        raise credential_exception
+    return payload.get("sub")
@@ -0,0 +1,177 @@
+import asyncio
+import codecs
+from collections import deque
+import json
+import logging
+from typing import Any, AsyncIterator
+
+from aiokafka import AIOKafkaProducer
+from pydantic import ValidationError
+
+from product_svc.codec import encode_product
+from product_svc.models import BulkResult, BulkRowError, Product
+from product_svc.producers.producer import product_key
+from product_svc.settings import BULK_MAX_IN_FLIGHT, BULK_MAX_ROW_BYTES, KAFKA_PRODUCT_TOPIC
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Only the first errors are returned, the counters still cover every row
+MAX_REPORTED_ERRORS = 1000
+
+JSON_SEPARATORS = " \t\r\n,"
+
+
+class RowError(Exception):
+    pass
+
+
+async def iter_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, Any]]:
+    # Decodes the body while it is being received, yielding (row number, object or RowError).
+    # A body starting with '[' is read as a JSON array, anything else as NDJSON (one object per line).
+    # At most one row (bounded by BULK_MAX_ROW_BYTES) is held in memory at a time.
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    json_decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    row = 0
+    is_array = None
+    skip_line = False
+    eof = False
+    chunk_iter = chunks.__aiter__()
+
+    while True:
+        if is_array is None:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                is_array = buffer[pos] == "["
+                if is_array:
+                    pos += 1
+
+        if is_array:
+            while pos < len(buffer) and buffer[pos] in JSON_SEPARATORS:
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            if pos < len(buffer):
+                try:
+                    obj, end = json_decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    # Either the element is still incomplete or it is malformed
+                    if eof:
+                        row += 1
+                        yield row, RowError(f"Malformed JSON array element, aborting import: {e.msg}")
+                        return
+                    if len(buffer) - pos > BULK_MAX_ROW_BYTES:
+                        # The end of the element can't be found without parsing it, there is no way to skip it
+                        row += 1
+                        yield row, RowError(f"Row exceeds {BULK_MAX_ROW_BYTES} bytes, aborting import")
+                        return
+                else:
+                    # A value ending exactly at the end of the buffer may continue in the next chunk
+                    if end < len(buffer) or eof:
+                        row += 1
+                        if end - pos > BULK_MAX_ROW_BYTES:
+                            # Ends the import like an element that is still incomplete at this size,
+                            # the outcome must not depend on how the body was chunked
+                            yield row, RowError(f"Row exceeds {BULK_MAX_ROW_BYTES} bytes, aborting import")
+                            return
+                        pos = end
+                        yield row, obj
+                        continue
+
+        elif is_array is False:
+            newline = buffer.find("\n", pos)
+            if newline == -1 and eof and pos < len(buffer):
+                newline = len(buffer)
+            if newline != -1:
+                line = buffer[pos:newline].strip()
+                pos = newline + 1
+                if skip_line:
+                    skip_line = False
+                elif len(line) > BULK_MAX_ROW_BYTES:
+                    row += 1
+                    yield row, RowError(f"Row exceeds {BULK_MAX_ROW_BYTES} bytes")
+                elif line:
+                    row += 1
+                    try:
+                        yield row, json.loads(line)
+                    except json.JSONDecodeError as e:
+                        yield row, RowError(f"Malformed JSON line: {e.msg}")
+                continue
+            if not skip_line and len(buffer) - pos > BULK_MAX_ROW_BYTES:
+                # Drop the oversized row and resynchronise on the next newline
+                row += 1
+                skip_line = True
+                yield row, RowError(f"Row exceeds {BULK_MAX_ROW_BYTES} bytes")
+            if skip_line:
+                pos = len(buffer)
+
+        if eof:
+            if is_array:
+                # Every element was complete, but the closing bracket never came
+                row += 1
+                yield row, RowError("JSON array is not closed, the body may be truncated")
+            return
+        try:
+            chunk = await chunk_iter.__anext__()
+        except StopAsyncIteration:
+            eof = True
+            chunk = b""
+        buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+        pos = 0
+
+
+async def produce_products(rows: AsyncIterator[tuple[int, Any]], producer: AIOKafkaProducer) -> BulkResult:
+    # Rows are validated one by one and handed to producer.send(), which only appends them to
+    # the producer's batch accumulator. The delivery futures are awaited once BULK_MAX_IN_FLIGHT
+    # of them are pending, so memory stays bounded while the broker receives full batches.
+    result = BulkResult()
+    in_flight: deque[tuple[int, str, asyncio.Future]] = deque()
+
+    def reject(row: int, product_id: str | None, error: str):
+        result.rejected += 1
+        if len(result.errors) < MAX_REPORTED_ERRORS:
+            result.errors.append(BulkRowError(row=row, product_id=product_id, error=error))
+        else:
+            result.errors_truncated = True
+
+    async def settle(row: int, product_id: str, future: asyncio.Future):
+        try:
+            await future
+            result.accepted += 1
+        except Exception as e:
+            reject(row, product_id, f"Delivery failed: {e}")
+
+    async for row, data in rows:
+        result.received += 1
+        if isinstance(data, RowError):
+            reject(row, None, str(data))
+            continue
+        try:
+            product = Product.model_validate(data)
+        except ValidationError as e:
+            product_id = data.get("product_id") if isinstance(data, dict) else None
+            product_id = str(product_id) if product_id is not None else None
+            reject(row, product_id, "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()))
+            continue
+
+        product.operation = "CREATE"
+        serialized_product = encode_product(product.__dict__)
+        try:
+            future = await producer.send(KAFKA_PRODUCT_TOPIC, serialized_product, key=product_key(product.product_id))
+        except Exception as e:
+            reject(row, product.product_id, f"Send failed: {e}")
+            continue
+        in_flight.append((row, product.product_id, future))
+
+        if len(in_flight) >= BULK_MAX_IN_FLIGHT:
+            await settle(*in_flight.popleft())
+
+    while in_flight:
+        await settle(*in_flight.popleft())
+
+    logger.info(f"Bulk import finished: {result.accepted} accepted, {result.rejected} rejected")
+    return result
@@ -0,0 +1,28 @@
+import json
+from typing import Any
+
+from product_svc.proto import product_pb2
+from product_svc.settings import KAFKA_PRODUCT_WIRE_FORMAT
+
+
+# Protobuf events start with a zero byte followed by the schema version. A JSON event always
+# starts with "{", so consumers can tell both formats apart without any other negotiation.
+MAGIC_BYTE = b"\x00"
+SCHEMA_VERSION = 1
+HEADER = MAGIC_BYTE + bytes([SCHEMA_VERSION])
+
+OPTIONAL_FIELDS = ("product_id", "name", "description", "price", "category")
+
+
+def encode_product(product: dict[str, Any], wire_format: str = KAFKA_PRODUCT_WIRE_FORMAT) -> bytes:
+    if wire_format == "json":
+        return json.dumps(product).encode('utf-8')
+
+    event = product_pb2.ProductEvent(operation=product_pb2.Operation.Value(product["operation"].upper()))
+    if product.get("id") is not None:
+        event.id = int(product["id"])
+    for field in OPTIONAL_FIELDS:
+        if product.get(field) is not None:
+            setattr(event, field, product[field])
+    return HEADER + event.SerializeToString()
+
@@ -3,20 +3,34 @@ from contextlib import asynccontextmanager
 # from fastapi.concurrency import asynccontextmanager
 import logging
 from typing import Annotated, Any, AsyncGenerator
-from fastapi import Depends, FastAPI
-
-# I will store in json format, therefore does not require the proto file
-# from product_svc.proto import product_pb2, operation_pb2
-import json
-
-from product_svc.models import Product, ProductUpdate
-from product_svc.settings import BOOTSTRAP_SERVER, KAFKA_PRODUCT_TOPIC
+from fastapi import Depends, FastAPI, HTTPException, Request
+
+# Events are encoded with the versioned protobuf schema in product_svc/proto (or legacy json)
+from product_svc.codec import encode_product
+# Writes require a user_svc access token once JWKS_URL is configured
+from product_svc.auth import authenticated_user
+from product_svc.bulk import iter_rows, produce_products
+from product_svc.models import BulkResult, Product, ProductUpdate
+from product_svc.partitions import topic_partitions
+from product_svc.producers.producer import create_producer, product_key, stop_producer
+from product_svc.settings import (BOOTSTRAP_SERVER, KAFKA_BULK_COMPRESSION_TYPE, KAFKA_BULK_LINGER_MS,
+                                  KAFKA_BULK_MAX_BATCH_SIZE, KAFKA_PRODUCT_STATE_TOPIC, KAFKA_PRODUCT_TOPIC,
+                                  KAFKA_PRODUCT_TOPIC_PARTITIONS, KAFKA_PRODUCT_TOPIC_REPLICATION_FACTOR)
 from aiokafka import AIOKafkaProducer
 from aiokafka.errors import KafkaConnectionError
 from aiokafka.admin import AIOKafkaAdminClient, NewTopic
 
 MAX_RETRIES = 5
 RETRY_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 5
+
+async def check_partitions(admin_client: AIOKafkaAdminClient):
+    # An existing topic keeps its partition count. Growing it moves product_ids to other partitions
+    # and must not happen behind the consumers' back, it is done with "python -m product_svc.partitions".
+    current = await topic_partitions(admin_client)
+    if current and current != KAFKA_PRODUCT_TOPIC_PARTITIONS:
+        logger.warning(f"Topic '{KAFKA_PRODUCT_TOPIC}' has {current} partitions, KAFKA_PRODUCT_TOPIC_PARTITIONS "
+                       f"is {KAFKA_PRODUCT_TOPIC_PARTITIONS}. Run 'python -m product_svc.partitions' to grow it.")
 
 async def create_topic():
     admin_client = AIOKafkaAdminClient(bootstrap_servers=BOOTSTRAP_SERVER)
@@ -28,13 +42,24 @@ async def create_topic():
         try:
             await admin_client.start()
             topic_list = [NewTopic(name=KAFKA_PRODUCT_TOPIC,
-                                num_partitions=2, 
-                                replication_factor=1)]
+                                num_partitions=KAFKA_PRODUCT_TOPIC_PARTITIONS, 
+                                replication_factor=KAFKA_PRODUCT_TOPIC_REPLICATION_FACTOR)]
+            if KAFKA_PRODUCT_STATE_TOPIC:
+                # Compaction keeps the last record per product_id and drops deleted products
+                topic_list.append(NewTopic(name=KAFKA_PRODUCT_STATE_TOPIC,
+                                           num_partitions=KAFKA_PRODUCT_TOPIC_PARTITIONS,
+                                           replication_factor=KAFKA_PRODUCT_TOPIC_REPLICATION_FACTOR,
+                                           topic_configs={"cleanup.policy": "compact"}))
+            for topic in topic_list:
+                try:
+                    await admin_client.create_topics(new_topics=[topic], validate_only=False)
+                    print(f"Topic '{topic.name}' created successfully")
+                except Exception as e:
+                    print(f"Failed to create topic '{topic.name}': {e}")
             try:
-                await admin_client.create_topics(new_topics=topic_list, validate_only=False)
-                print(f"Topic '{KAFKA_PRODUCT_TOPIC}' created successfully")
+                await check_partitions(admin_client)
             except Exception as e:
-                print(f"Failed to create topic '{KAFKA_PRODUCT_TOPIC}': {e}")
+                print(f"Failed to check the partitions of topic '{KAFKA_PRODUCT_TOPIC}': {e}")
             finally:
                 await admin_client.close()
             return
@@ -46,18 +71,35 @@ async def create_topic():
         
     raise Exception("Failed to connect to kafka broker after several retries")
 
-async def kafka_producer():
-    producer = AIOKafkaProducer(bootstrap_servers=BOOTSTRAP_SERVER)
-    await producer.start()
-    try:
-        yield producer
-    finally:
-        await producer.stop()
+# The producer is owned by the lifespan and shared by all requests of this worker,
+# the dependency only hands out the already started instance
+def kafka_producer(request: Request) -> AIOKafkaProducer:
+    return request.app.state.producer
+
+# Separate producer for bulk imports, tuned for throughput (linger + compression) so it
+# does not add latency to the single product endpoints
+def kafka_bulk_producer(request: Request) -> AIOKafkaProducer:
+    return request.app.state.bulk_producer
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     await create_topic()
-    yield
+    producer = await create_producer()
+    if not producer:
+        raise Exception("Failed to create kafka product producer")
+    bulk_producer = await create_producer(linger_ms=KAFKA_BULK_LINGER_MS,
+                                          compression_type=KAFKA_BULK_COMPRESSION_TYPE,
+                                          max_batch_size=KAFKA_BULK_MAX_BATCH_SIZE)
+    if not bulk_producer:
+        await stop_producer(producer)
+        raise Exception("Failed to create kafka bulk product producer")
+    app.state.producer = producer
+    app.state.bulk_producer = bulk_producer
+    try:
+        yield
+    finally:
+        await stop_producer(bulk_producer)
+        await stop_producer(producer)
 
 app = FastAPI(lifespan=lifespan, title="Product Service", version='1.0.0')
 
@@ -65,10 +107,18 @@ app = FastAPI(lifespan=lifespan, title="Product Service", version='1.0.0')
 async def root() -> Any:
     return {"message": "Welcome to Products Producer Service"}
 
+@app.get('/health')
+async def health(producer: Annotated[AIOKafkaProducer, Depends(kafka_producer)]) -> Any:
+    try:
+        partitions = await asyncio.wait_for(producer.partitions_for(KAFKA_PRODUCT_TOPIC), HEALTH_CHECK_TIMEOUT)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Kafka producer unavailable: {e}")
+    return {"status": "ok", "topic": KAFKA_PRODUCT_TOPIC, "partitions": len(partitions)}
+
 logging.basicConfig(level= logging.INFO)
 logger = logging.getLogger(__name__)
 
-@app.post('/products/')
+@app.post('/products/', dependencies=[Depends(authenticated_user)])
 # Try following instead of above when returning something in response_model=Product
 # @app.post('/products/', response_model=Product)
 async def create_product(
@@ -77,16 +127,28 @@ async def create_product(
 ):
 
     product.operation = "CREATE"
-    serialized_product = json.dumps(product.__dict__).encode('utf-8')
+    serialized_product = encode_product(product.__dict__)
 
     logger.info(f"Received Message: {serialized_product}")
 
-    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product)
+    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product, key=product_key(product.product_id))
 
     return {"message" : "Created product successfully!"}
 
-@app.put('/products/{id}')
-async def edit_product(id: int, 
+# Accepts an NDJSON stream or a JSON array of products. Rows are validated while the body is
+# being received and failed rows are reported back without stopping the import.
+@app.post('/products/bulk', response_model=BulkResult, dependencies=[Depends(authenticated_user)])
+async def create_products_bulk(
+    request: Request,
+    producer: Annotated[AIOKafkaProducer, Depends(kafka_bulk_producer)]
+) -> BulkResult:
+
+    return await produce_products(iter_rows(request.stream()), producer)
+
+# Products are addressed by product_id, the message key, so updates and deletes land on the
+# same partition as the product's CREATE event
+@app.put('/products/{product_id}', dependencies=[Depends(authenticated_user)])
+async def edit_product(product_id: str, 
                        product: ProductUpdate,
                        producer: Annotated[AIOKafkaProducer, Depends(kafka_producer)]
                        ):
@@ -94,24 +156,24 @@ async def edit_product(id: int,
     logger.info(f"Received product data for update: {product}")
 
     product.operation = "UPDATE"
-    product.id = str(id)  # Ensure id is a string for serialization
+    product.product_id = product_id  # The key of a product cannot be changed by an update
 
-    serialized_product = json.dumps(product.__dict__).encode('utf-8')
-    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product)
+    serialized_product = encode_product(product.__dict__)
+    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product, key=product_key(product_id))
 
     return {"message": "Product updated successfully!"}
 
-@app.delete('/products/{id}')
-async def delete_product(id: int, 
+@app.delete('/products/{product_id}', dependencies=[Depends(authenticated_user)])
+async def delete_product(product_id: str, 
                          producer: Annotated[AIOKafkaProducer, Depends(kafka_producer)]
                          ):
     
-    logger.info(f"Received product data for deletion: {id}")
+    logger.info(f"Received product data for deletion: {product_id}")
 
-    product = ProductUpdate(id=str(id))
+    product = ProductUpdate(product_id=product_id)
     product.operation = "DELETE"
 
-    serialized_product = json.dumps(product.__dict__).encode('utf-8')
-    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product)
+    serialized_product = encode_product(product.__dict__)
+    await producer.send_and_wait(KAFKA_PRODUCT_TOPIC, serialized_product, key=product_key(product_id))
 
     return {"message": "Product deleted successfully!"}
\ No newline at end of file
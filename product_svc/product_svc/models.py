@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 class Product(BaseModel):
@@ -9,11 +9,24 @@ class Product(BaseModel):
     category: str
     operation: Optional[str] = None
 
+# Updates are addressed by the product_id in the URL only, a database id in the body is ignored
 class ProductUpdate(BaseModel):
-    id: Optional[str] = None
     product_id: Optional[str] = None
     name: Optional[str] = None
     description: Optional[str] = None
     price: Optional[float] = None
     category: Optional[str] = None
     operation: Optional[str] = None
+
+# response models of the bulk ingest endpoint
+class BulkRowError(BaseModel):
+    row: int
+    product_id: Optional[str] = None
+    error: str
+
+class BulkResult(BaseModel):
+    received: int = 0
+    accepted: int = 0
+    rejected: int = 0
+    errors: List[BulkRowError] = []
+    errors_truncated: bool = False
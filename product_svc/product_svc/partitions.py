@@ -0,0 +1,48 @@
+# Grows the product topic to KAFKA_PRODUCT_TOPIC_PARTITIONS partitions, an explicit admin step:
+#   python -m product_svc.partitions
+# Adding partitions sends the new events of some product_ids to a different partition than their
+# earlier ones. Until product_db has consumed the earlier events, the new ones may be applied first,
+# so stop the writes and wait for the consumer lag to reach zero before running it.
+# Kafka cannot reduce the partition count of a topic.
+import argparse
+import asyncio
+import logging
+
+from aiokafka.admin import AIOKafkaAdminClient, NewPartitions
+from product_svc.settings import BOOTSTRAP_SERVER, KAFKA_PRODUCT_TOPIC, KAFKA_PRODUCT_TOPIC_PARTITIONS
+
+logging.basicConfig(level= logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def topic_partitions(admin_client: AIOKafkaAdminClient) -> int:
+    # 0 if the topic does not exist
+    topics = await admin_client.describe_topics([KAFKA_PRODUCT_TOPIC])
+    return len(topics[0]["partitions"]) if topics else 0
+
+async def grow_partitions(partitions: int):
+    admin_client = AIOKafkaAdminClient(bootstrap_servers=BOOTSTRAP_SERVER)
+    await admin_client.start()
+    try:
+        current = await topic_partitions(admin_client)
+        if current == 0:
+            raise Exception(f"Topic '{KAFKA_PRODUCT_TOPIC}' does not exist")
+        if partitions <= current:
+            logger.info(f"Topic '{KAFKA_PRODUCT_TOPIC}' already has {current} partitions, nothing to do")
+            return
+        await admin_client.create_partitions({KAFKA_PRODUCT_TOPIC: NewPartitions(partitions)})
+        logger.info(f"Topic '{KAFKA_PRODUCT_TOPIC}' grown from {current} to {partitions} partitions")
+    finally:
+        await admin_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Grow the partition count of {KAFKA_PRODUCT_TOPIC}")
+    parser.add_argument("--partitions", type=int, default=KAFKA_PRODUCT_TOPIC_PARTITIONS,
+                        help="new partition count, KAFKA_PRODUCT_TOPIC_PARTITIONS by default")
+    args = parser.parse_args()
+    asyncio.run(grow_partitions(args.partitions))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,4 +7,28 @@ except FileNotFoundError:
     config = Config()
 
 BOOTSTRAP_SERVER = config("BOOTSTRAP_SERVER", cast=str)
-KAFKA_PRODUCT_TOPIC = config("KAFKA_PRODUCT_TOPIC", cast=str)
\ No newline at end of file
+KAFKA_PRODUCT_TOPIC = config("KAFKA_PRODUCT_TOPIC", cast=str)
+# Upper bound for the number of consumers that can work on the topic in parallel
+KAFKA_PRODUCT_TOPIC_PARTITIONS = config("KAFKA_PRODUCT_TOPIC_PARTITIONS", cast=int, default=2)
+KAFKA_PRODUCT_TOPIC_REPLICATION_FACTOR = config("KAFKA_PRODUCT_TOPIC_REPLICATION_FACTOR", cast=int, default=1)
+
+# Bulk ingest producer: batches are allowed to linger so many rows share one compressed request
+KAFKA_BULK_LINGER_MS = config("KAFKA_BULK_LINGER_MS", cast=int, default=20)
+KAFKA_BULK_COMPRESSION_TYPE = config("KAFKA_BULK_COMPRESSION_TYPE", cast=str, default="gzip")
+KAFKA_BULK_MAX_BATCH_SIZE = config("KAFKA_BULK_MAX_BATCH_SIZE", cast=int, default=262144)
+BULK_MAX_IN_FLIGHT = config("BULK_MAX_IN_FLIGHT", cast=int, default=1000)
+BULK_MAX_ROW_BYTES = config("BULK_MAX_ROW_BYTES", cast=int, default=1048576)
+
+# Wire format of published product events: "protobuf" (compact, versioned) or "json" (legacy).
+# product_db decodes both, switch consumers to a version that understands protobuf first.
+KAFKA_PRODUCT_WIRE_FORMAT = config("KAFKA_PRODUCT_WIRE_FORMAT", cast=str, default="protobuf")
+
+# Callers are authenticated with access tokens issued by user_svc, verified locally against its
+# published key set. Keys are cached for JWKS_CACHE_SECONDS, an unknown kid triggers a refetch.
+# Authentication is disabled while JWKS_URL is empty (e.g. http://user_svc:8000/.well-known/jwks.json).
+JWKS_URL = config("JWKS_URL", cast=str, default="")
+JWKS_CACHE_SECONDS = config("JWKS_CACHE_SECONDS", cast=float, default=300)
+
+# Log-compacted topic holding the latest state of every product, published by product_db after it
+# applies the events (product_svc only sees partial updates). Created here next to the event topic.
+KAFKA_PRODUCT_STATE_TOPIC = config("KAFKA_PRODUCT_STATE_TOPIC", cast=str, default=f"{KAFKA_PRODUCT_TOPIC}.state")
@@ -0,0 +1,14 @@
+from pathlib import Path
+
+import pytest
+
+SERVICES_DIR = Path(__file__).resolve().parents[2]
+
+
+def test_auth_is_identical_to_the_product_db_copy():
+    # Only the package of the settings import differs
+    other = SERVICES_DIR / "product_db" / "product_db" / "auth.py"
+    if not other.exists():
+        pytest.skip("product_db is not part of this checkout")
+    auth = (SERVICES_DIR / "product_svc" / "product_svc" / "auth.py").read_text()
+    assert auth.replace("from product_svc.", "from product_db.") == other.read_text()
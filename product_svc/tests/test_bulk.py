@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+from product_svc import bulk
+from product_svc.bulk import RowError, iter_rows
+
+
+def read(*chunks: bytes) -> list:
+    async def body():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [(row, str(data) if isinstance(data, RowError) else data) async for row, data in iter_rows(body())]
+
+    return asyncio.run(collect())
+
+def split(body: bytes, size: int) -> list[bytes]:
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+PRODUCTS = [{"product_id": str(i), "name": "café ☕", "price": i} for i in range(5)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 64, 10_000])
+def test_ndjson_across_chunk_boundaries(size):
+    body = b"\n".join(json.dumps(product, ensure_ascii=False).encode() for product in PRODUCTS)
+    assert read(*split(body, size)) == list(enumerate(PRODUCTS, 1))
+
+@pytest.mark.parametrize("size", [1, 3, 64, 10_000])
+def test_json_array_across_chunk_boundaries(size):
+    body = json.dumps(PRODUCTS, ensure_ascii=False, indent=2).encode()
+    assert read(*split(body, size)) == list(enumerate(PRODUCTS, 1))
+
+def test_empty_bodies():
+    assert read(b"") == []
+    assert read(b" \n") == []
+    assert read(b"[ ]") == []
+
+def test_ndjson_malformed_line_is_reported_and_skipped():
+    assert read(b'{"a": 1}\n{"a":\n\n{"a": 3}') == [
+        (1, {"a": 1}), (2, "Malformed JSON line: Expecting value"), (3, {"a": 3})]
+
+def test_json_array_malformed_element_aborts():
+    assert read(b'[{"a": 1}, {"a": }, {"a": 3}]') == [
+        (1, {"a": 1}), (2, "Malformed JSON array element, aborting import: Expecting value")]
+
+def test_json_array_without_closing_bracket_is_reported():
+    rows = read(b'[{"a": 1},', b' {"a": 2}')
+    assert rows[:2] == [(1, {"a": 1}), (2, {"a": 2})]
+    assert rows[2][0] == 3 and "not closed" in rows[2][1]
+    assert read(b'[{"a": 1}, ')[1][1].startswith("JSON array is not closed")
+
+@pytest.mark.parametrize("size", [1, 7, 10_000])
+def test_ndjson_oversized_line_is_rejected(monkeypatch, size):
+    monkeypatch.setattr(bulk, "BULK_MAX_ROW_BYTES", 20)
+    body = b'{"a": 1}\n{"a": "' + b"x" * 30 + b'"}\n{"a": 3}\n'
+    assert read(*split(body, size)) == [(1, {"a": 1}), (2, "Row exceeds 20 bytes"), (3, {"a": 3})]
+
+@pytest.mark.parametrize("size", [1, 7, 10_000])
+def test_json_array_oversized_element_aborts_regardless_of_chunking(monkeypatch, size):
+    monkeypatch.setattr(bulk, "BULK_MAX_ROW_BYTES", 20)
+    body = b'[{"a": 1}, {"a": "' + b"x" * 30 + b'"}, {"a": 3}]'
+    assert read(*split(body, size)) == [(1, {"a": 1}), (2, "Row exceeds 20 bytes, aborting import")]
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+from product_svc import main, partitions
+from product_svc.settings import KAFKA_PRODUCT_TOPIC
+
+
+class FakeAdminClient:
+    def __init__(self, partition_count: int, **config):
+        self.partition_count = partition_count
+        self.grown_to = None
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def describe_topics(self, topics):
+        return [{"topic": KAFKA_PRODUCT_TOPIC, "partitions": [{"partition": p} for p in range(self.partition_count)]}]
+
+    async def create_partitions(self, new_partitions):
+        self.grown_to = new_partitions[KAFKA_PRODUCT_TOPIC].total_count
+
+
+def test_startup_only_warns_about_a_different_partition_count(monkeypatch, caplog):
+    monkeypatch.setattr(main, "KAFKA_PRODUCT_TOPIC_PARTITIONS", 4)
+    admin_client = FakeAdminClient(2)
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(main.check_partitions(admin_client))
+    assert admin_client.grown_to is None
+    assert "has 2 partitions" in caplog.text
+
+def test_grow_partitions_only_grows(monkeypatch):
+    clients = []
+
+    def admin_client(**config):
+        clients.append(FakeAdminClient(2))
+        return clients[-1]
+
+    monkeypatch.setattr(partitions, "AIOKafkaAdminClient", admin_client)
+    asyncio.run(partitions.grow_partitions(4))
+    asyncio.run(partitions.grow_partitions(1))
+    assert [client.grown_to for client in clients] == [4, None]
@@ -0,0 +1,67 @@
+import json
+from typing import Any
+
+from aiokafka.partitioner import DefaultPartitioner
+from fastapi.testclient import TestClient
+from product_svc.codec import HEADER, MAGIC_BYTE, OPTIONAL_FIELDS
+from product_svc.main import app
+from product_svc.proto import product_pb2
+from product_svc.producers.producer import product_key
+
+
+def decode_product(value: bytes) -> dict[str, Any]:
+    # Reads back the events the service sent, in either wire format
+    if not value.startswith(MAGIC_BYTE):
+        return json.loads(value)
+    assert value.startswith(HEADER)
+    event = product_pb2.ProductEvent.FromString(value[len(HEADER):])
+    product: dict[str, Any] = {"operation": product_pb2.Operation.Name(event.operation)}
+    for field in ("id", *OPTIONAL_FIELDS):
+        product[field] = getattr(event, field) if event.HasField(field) else None
+    return product
+
+
+class RecordingProducer:
+    def __init__(self):
+        self.sent = []
+
+    async def send_and_wait(self, topic, value, key=None):
+        self.sent.append((topic, value, key))
+
+
+def test_events_of_a_product_share_a_partition():
+    partitioner = DefaultPartitioner()
+    partitions = list(range(12))
+    for product_id in ("abc", "product-42", "ß-unicode"):
+        chosen = {partitioner(product_key(product_id), partitions, partitions) for _ in range(3)}
+        assert len(chosen) == 1
+        assert product_key(product_id) == product_id.encode('utf-8')
+
+def test_update_is_keyed_by_the_url_product_id_only():
+    producer = RecordingProducer()
+    app.state.producer = producer
+    client = TestClient(app)
+
+    response = client.put("/products/abc", json={"id": "1", "product_id": "other", "name": "x"})
+    assert response.status_code == 200, response.text
+
+    _, value, key = producer.sent[0]
+    event = decode_product(value)
+    assert key == b"abc"
+    assert event["operation"] == "UPDATE"
+    assert event["product_id"] == "abc"
+    assert event["id"] is None
+    assert event["name"] == "x"
+
+def test_create_update_delete_use_the_same_key():
+    producer = RecordingProducer()
+    app.state.producer = producer
+    client = TestClient(app)
+
+    client.post("/products/", json={"product_id": "abc", "name": "n", "description": "d",
+                                    "price": 1.5, "category": "c"})
+    client.put("/products/abc", json={"price": 2.5})
+    client.delete("/products/abc")
+
+    assert [key for _, _, key in producer.sent] == [b"abc"] * 3
+    assert [decode_product(value)["operation"] for _, value, _ in producer.sent] == ["CREATE", "UPDATE", "DELETE"]
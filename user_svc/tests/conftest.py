@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+import pytest
+from starlette.config import Config
+
+# The service builds its engine from DATABASE_URL on import, point it at the test database first
+try:
+    config = Config(".env")
+except FileNotFoundError:
+    config = Config()
+
+test_database_url = str(config("TEST_DATABASE_URL"))
+# The tests commit users and token families, they must never run against the service's own database
+if test_database_url == str(config("DATABASE_URL", default="")):
+    raise pytest.UsageError("TEST_DATABASE_URL is the same as DATABASE_URL, point it at a separate, disposable database")
+os.environ["DATABASE_URL"] = test_database_url
+os.environ.setdefault("JWT_KEYS_DIR", tempfile.mkdtemp())
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from jose import jwt, JWTError
+from user_svc import auth, keys
+
+
+def legacy_token() -> str:
+    # Signed like the tokens issued before asymmetric signing: shared secret, no kid, no type
+    claims = {"sub": "legacy", "exp": datetime.now(timezone.utc) + timedelta(minutes=5)}
+    return jwt.encode(claims, auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+
+def untyped_token() -> str:
+    return keys.sign({"sub": "untyped", "exp": datetime.now(timezone.utc) + timedelta(minutes=5)})
+
+
+def test_typed_tokens_are_only_accepted_as_their_type():
+    access = auth.create_access_token({"sub": "user"}, timedelta(minutes=5))
+    assert auth.decode_token(access, "access")["sub"] == "user"
+    with pytest.raises(JWTError):
+        auth.decode_token(access, "refresh")
+
+def test_tokens_without_type_are_rejected():
+    with pytest.raises(JWTError):
+        auth.decode_token(untyped_token(), "access")
+    with pytest.raises(JWTError):
+        auth.decode_token(untyped_token(), "refresh")
+
+def test_legacy_tokens_are_rejected_by_default(monkeypatch):
+    monkeypatch.setattr(auth, "LEGACY_TOKENS_UNTIL", auth.legacy_tokens_until(""))
+    with pytest.raises(JWTError):
+        auth.decode_token(legacy_token(), "access")
+
+def test_legacy_tokens_are_accepted_as_access_tokens_until_the_cutover_has_passed(monkeypatch):
+    now = datetime.now(timezone.utc)
+    monkeypatch.setattr(auth, "LEGACY_TOKENS_UNTIL", auth.legacy_tokens_until(now.isoformat()))
+    assert auth.decode_token(legacy_token(), "access")["sub"] == "legacy"
+    with pytest.raises(JWTError):
+        auth.decode_token(legacy_token(), "refresh")
+
+    expired_cutover = (now - timedelta(minutes=auth.EXPIRY_TIME + 1)).replace(tzinfo=None).isoformat()
+    monkeypatch.setattr(auth, "LEGACY_TOKENS_UNTIL", auth.legacy_tokens_until(expired_cutover))
+    with pytest.raises(JWTError):
+        auth.decode_token(legacy_token(), "access")
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from user_svc.ratelimit import InMemoryBackend, check_limits, refill, wait_time
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_refill():
+    assert refill(None, 5, rate=1, burst=3) == 3
+    assert refill((0.5, 10), 11, rate=0.25, burst=3) == 0.75
+    # Never more than the burst
+    assert refill((2, 10), 100, rate=1, burst=3) == 3
+
+def test_wait_time():
+    assert wait_time(1, rate=0.5) == 0
+    assert wait_time(0.5, rate=0.25) == 2
+
+def test_bucket_allows_the_burst_then_refills():
+    clock = Clock()
+    backend = InMemoryBackend(max_buckets=10, clock=clock)
+    bucket = [("key", 0.5, 2)]
+
+    async def run():
+        results = [await backend.acquire(bucket) for _ in range(3)]
+        clock.now += 2
+        results.append(await backend.acquire(bucket))
+        return results
+
+    assert asyncio.run(run()) == [0, 0, 2, 0]
+
+def test_rejected_request_spends_no_token_of_any_bucket():
+    clock = Clock()
+    backend = InMemoryBackend(max_buckets=10, clock=clock)
+    ip, user = ("ip", 1, 5), ("user", 1, 1)
+
+    async def run():
+        assert await backend.acquire([ip, user]) == 0
+        # The user bucket is empty, the request is rejected without touching the ip bucket
+        for _ in range(3):
+            assert await backend.acquire([ip, user]) > 0
+        return [await backend.acquire([ip, (f"user {i}", 1, 1)]) for i in range(4)]
+
+    assert asyncio.run(run()) == [0, 0, 0, 0]
+
+def test_least_recently_used_buckets_are_dropped():
+    backend = InMemoryBackend(max_buckets=2, clock=Clock())
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await backend.acquire([(key, 1, 1)])
+
+    asyncio.run(run())
+    assert list(backend._buckets) == ["b", "c"]
+
+@pytest.mark.parametrize("limits", [
+    {"RATE_LIMIT_IP_PER_MINUTE": 0},
+    {"RATE_LIMIT_USERNAME_PER_MINUTE": -1},
+    {"RATE_LIMIT_IP_BURST": 0.5},
+])
+def test_invalid_limits_are_rejected(limits):
+    with pytest.raises(ValueError):
+        check_limits(limits)
@@ -0,0 +1,53 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from user_svc.main import app
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+def login(client: TestClient) -> dict:
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    response = client.post("/register", params={"username": username, "email": f"{username}@example.com",
+                                                "password": "secret-password"})
+    assert response.status_code == 200, response.text
+    response = client.post("/token", data={"username": username, "password": "secret-password"})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def refresh(client: TestClient, refresh_token: str):
+    return client.post("/token/refresh", params={"old_refresh_token": refresh_token})
+
+
+def test_login_issues_access_and_refresh_token(client):
+    tokens = login(client)
+    assert tokens["token_type"] == "bearer"
+    assert tokens["access_token"] and tokens["refresh_token"]
+
+def test_refresh_rotates_the_refresh_token(client):
+    tokens = login(client)
+    response = refresh(client, tokens["refresh_token"])
+    assert response.status_code == 200, response.text
+    rotated = response.json()
+    assert rotated["refresh_token"] != tokens["refresh_token"]
+    assert refresh(client, rotated["refresh_token"]).status_code == 200
+
+def test_reused_refresh_token_revokes_the_family(client):
+    tokens = login(client)
+    rotated = refresh(client, tokens["refresh_token"]).json()
+
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+    # The token issued by the rotation belongs to the revoked family
+    assert refresh(client, rotated["refresh_token"]).status_code == 401
+
+def test_revoke_ends_the_login(client):
+    tokens = login(client)
+    rotated = refresh(client, tokens["refresh_token"]).json()
+
+    response = client.post("/token/revoke", params={"refresh_token": rotated["refresh_token"]})
+    assert response.status_code == 200, response.text
+    assert refresh(client, rotated["refresh_token"]).status_code == 401
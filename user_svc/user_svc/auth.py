@@ -1,13 +1,17 @@
 import logging
 from datetime import datetime, timezone, timedelta
 from typing import Annotated
-from passlib.context import CryptContext
-from sqlmodel import Session, select
+from sqlalchemy import or_
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from fastapi import Depends, HTTPException, status
 # from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from user_svc.models import RefreshTokenData, TokenData, User, Token, Profile
 from user_svc.db import get_session
+from user_svc import hashing, keys, tokens
+from user_svc.cache import user_cache
+from user_svc.settings import JWT_LEGACY_CUTOVER
 from dotenv import load_dotenv
 import os
 
@@ -17,6 +21,16 @@ ALGORITHM = os.getenv('ALGORITHM')
 EXPIRY_TIME = int(os.getenv('EXPIRY_TIME'))
 REFRESH_EXPIRY_DAYS = int(os.getenv('REFRESH_EXPIRY_DAYS'))
 
+def legacy_tokens_until(cutover: str) -> datetime | None:
+    if not cutover:
+        return None
+    cutover_at = datetime.fromisoformat(cutover)
+    if cutover_at.tzinfo is None:
+        cutover_at = cutover_at.replace(tzinfo=timezone.utc)
+    return cutover_at + timedelta(minutes=EXPIRY_TIME)
+
+LEGACY_TOKENS_UNTIL = legacy_tokens_until(JWT_LEGACY_CUTOVER)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -27,56 +41,96 @@ print(f"EXPIRY_TIME: {type(EXPIRY_TIME)}, {EXPIRY_TIME}")
 print(f"REFRESH_EXPIRY_DAYS: {REFRESH_EXPIRY_DAYS}")
 
 
-pwd_context = CryptContext(schemes="bcrypt")
+# bcrypt takes 100-300 ms of CPU, hashing is done in the worker pool of user_svc.hashing
+async def hash_password(password) -> str:
+    return await hashing.hash_password(password)
 
-def hash_password(password) -> str:
-    return pwd_context.hash(password)
+async def verify_password(password, password_hash) -> tuple[bool, str | None]:
+    return await hashing.verify_password(password, password_hash)
 
-def verify_password(password, password_hash) -> bool:
-    return pwd_context.verify(password, password_hash)
-
-def get_user_from_db(
-        session: Annotated[Session, Depends(get_session)],
+async def get_user_from_db(
+        session: Annotated[AsyncSession, Depends(get_session)],
         username: str | None = None,
         email: str | None = None
 ) -> User | None:
-    statement = select(User).where(User.username == username)
-    user: User | None = session.exec(statement).first()
-    if not user:
-        statement = select(User).where(User.email == email)
-        user: User | None = session.exec(statement).first()
-        if user:
-            return user
+    # One query on the unique (indexed) username and email columns. When both are given and
+    # match different users, the username match wins.
+    conditions = []
+    if username is not None:
+        conditions.append(col(User.username) == username)
+    if email is not None:
+        conditions.append(col(User.email) == email)
+    if not conditions:
+        return None
+    statement = select(User).where(or_(*conditions))
+    if len(conditions) > 1:
+        statement = statement.order_by((col(User.username) == username).desc())
+    user: User | None = (await session.exec(statement.limit(1))).first()
     return user
 
-def get_user_data_from_db(
-        session: Annotated[Session, Depends(get_session)],
-        username: str
+async def get_user_data_from_db(
+        session: Annotated[AsyncSession, Depends(get_session)],
+        user_id: int
 ) -> Profile | None:
 
-    statement = select(Profile).where(Profile.username == username)
-    user_profile = session.exec(statement).first()
-    logger.info(f" user_profile: {user_profile}")
-    # print (f" user_profile: {user_profile}")
+    statement = select(Profile).where(Profile.user_id == user_id)
+    user_profile = (await session.exec(statement)).first()
     if not user_profile:
         return None
 
     return user_profile
 
+async def get_user_with_profile(
+        session: Annotated[AsyncSession, Depends(get_session)],
+        username: str
+) -> tuple[User, Profile | None] | None:
+    # The user and its profile (if any) in one round trip
+    statement = (
+        select(User, Profile)
+        .outerjoin(Profile, col(Profile.user_id) == col(User.id))
+        .where(User.username == username)
+    )
+    row = (await session.exec(statement)).first()
+    if not row:
+        return None
+    return row[0], row[1]
+
 
-def authenticate_user(
+async def authenticate_user(
         username,
         password,
-        session: Annotated[Session, Depends(get_session)]
+        session: Annotated[AsyncSession, Depends(get_session)]
 ) -> User | None:
 
-    db_user = get_user_from_db(session=session, username=username)
+    db_user = await get_user_from_db(session=session, username=username)
     if not db_user:
         return None
-    if not verify_password(password, db_user.password):
+    valid, new_hash = await verify_password(password, db_user.password)
+    if not valid:
         return None
+    if new_hash:
+        # The stored hash was made with other cost parameters, replace it while we know the password
+        db_user.password = new_hash
+        session.add(db_user)
+        await session.commit()
+        await session.refresh(db_user)
+        user_cache.invalidate(db_user.username)
     return db_user
 
+def decode_token(token: str, token_type: str) -> dict:
+    # Tokens are signed with the key named by their kid header and carry their type. Access tokens
+    # issued with the shared SECRET_KEY before that have neither, they are accepted as access tokens
+    # only until LEGACY_TOKENS_UNTIL.
+    legacy = (token_type == "access" and LEGACY_TOKENS_UNTIL is not None
+              and datetime.now(timezone.utc) < LEGACY_TOKENS_UNTIL)
+    payload = keys.decode(token, legacy_secret=SECRET_KEY if legacy else None, legacy_algorithm=ALGORITHM)
+    claimed_type = payload.get("type")
+    if claimed_type is None and legacy and jwt.get_unverified_header(token).get("kid") is None:
+        claimed_type = "access"
+    if claimed_type != token_type:
+        raise JWTError(f"Expected {token_type} token")
+    return payload
+
 def create_access_token(
         data: dict,
         expiry_time: timedelta | None
@@ -87,10 +141,8 @@ def create_access_token(
         expire = datetime.now(timezone.utc) + expiry_time
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    data_to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        data_to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    print("SECRET_KEY is ", SECRET_KEY)
+    data_to_encode.update({"exp": expire, "type": "access"})
+    encoded_jwt = keys.sign(data_to_encode)
     return encoded_jwt
 
 def create_refresh_token(
@@ -102,41 +154,67 @@ def create_refresh_token(
         expire = datetime.now(timezone.utc) + expiry_time
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    data_to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        data_to_encode, SECRET_KEY, algorithm=ALGORITHM, )
+    data_to_encode.update({"exp": expire, "type": "refresh"})
+    encoded_jwt = keys.sign(data_to_encode)
     return encoded_jwt
 
-def validate_refresh_token(
+async def validate_refresh_token(
         token: str,
-        session: Annotated[Session, Depends(get_session)]
-):
-
+        session: Annotated[AsyncSession, Depends(get_session)]
+) -> tuple[User, str]:
+    # Exchanging a refresh token uses it up, the caller issues the next token of the same family.
+    # Returns the user and the family.
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid token, Please login again",
         headers={"www-Authenticate": "Bearer"}
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, ALGORITHM)
-        email: str | None = payload.get("sub")
-        if email is None:
-            raise credential_exception
-        token_data = RefreshTokenData(email=email)
-    except:
-        raise JWTError
-    user = get_user_from_db(session, email=token_data.email)
+        payload = decode_token(token, "refresh")
+        token_data = RefreshTokenData(email=payload["sub"])
+        jti: str = payload["jti"]
+        family_id: str = payload["fam"]
+    except (JWTError, KeyError):
+        # Refresh tokens issued before rotation carry no jti, their users log in again
+        raise credential_exception
+    # Tokens of a revoked family are turned away without touching the database
+    if await tokens.is_revoked(session, family_id):
+        raise credential_exception
+    if await tokens.use_refresh_token(session, jti) != family_id:
+        raise credential_exception
+    user = await get_user_from_db(session, email=token_data.email)
     if not user:
         raise credential_exception
-    return user
+    return user, family_id
 
-def token_service(user: User) -> Token:
+async def revoke_refresh_token(
+        token: str,
+        session: Annotated[AsyncSession, Depends(get_session)]
+):
+    # Logs out the session the token belongs to: every token of its family stops working
+    try:
+        payload = decode_token(token, "refresh")
+        family_id: str = payload["fam"]
+    except (JWTError, KeyError):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    await tokens.revoke_family(session, family_id)
+
+async def token_service(
+        session: Annotated[AsyncSession, Depends(get_session)],
+        user: User,
+        family_id: str | None = None
+) -> Token:
+    # A login starts a new token family, a refresh continues the family of the used token
+    jti = tokens.new_id()
+    refresh_expire_time = timedelta(days=REFRESH_EXPIRY_DAYS)
+    family_id = await tokens.add_refresh_token(
+        session, user.id, family_id, jti, datetime.now(timezone.utc) + refresh_expire_time)
+    await session.commit()
     expire_time = timedelta(minutes=EXPIRY_TIME)
     access_token = create_access_token(
-        {"sub": user.username}, expire_time)
-    refresh_expire_time = timedelta(days=REFRESH_EXPIRY_DAYS)
+        {"sub": user.username, "fam": family_id}, expire_time)
     refresh_token = create_refresh_token(
-        {"sub": user.email}, refresh_expire_time)
+        {"sub": user.email, "jti": jti, "fam": family_id}, refresh_expire_time)
     return Token(access_token=access_token, token_type="bearer", refresh_token=refresh_token)
 
 
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+import time
+from typing import Any, Hashable
+
+from user_svc.settings import (PROFILE_CACHE_MAX_ENTRIES, PROFILE_CACHE_TTL_SECONDS, USER_CACHE_MAX_ENTRIES,
+                               USER_CACHE_TTL_SECONDS)
+
+
+class LRUCache:
+    # Bounded LRU cache with a per-entry TTL. The event loop is single threaded, so no locking
+    # is needed.
+    #
+    # Every invalidation bumps the generation. A reader takes the generation before querying
+    # the database and put() drops its value if the data was changed in the meantime, so a read
+    # racing with a write cannot store an outdated object.
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, generation: int | None = None, ttl_seconds: float | None = None):
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def write(self, key: Hashable, value: Any):
+        # Write-through after a change. Readers that loaded the old value before the change cannot
+        # overwrite it anymore.
+        self.generation += 1
+        self.put(key, value)
+
+    def invalidate(self, key: Hashable):
+        self.generation += 1
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+# Users of current_user keyed by username
+user_cache = LRUCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+# Profiles of /profile/me keyed by user id, written through by the profile endpoints
+profile_cache = LRUCache(PROFILE_CACHE_MAX_ENTRIES, PROFILE_CACHE_TTL_SECONDS)
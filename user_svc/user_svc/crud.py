@@ -0,0 +1,27 @@
+from typing import Any, AsyncIterator
+
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from user_svc.models import User
+
+# Columns returned by the user listings, password hashes never leave the service
+USER_EXPORT_COLUMNS = (User.id, User.username, User.email)
+
+
+def select_users(after_id: int | None = None, limit: int | None = None):
+    # Keyset pagination on the primary key: every page is an index range scan starting after the
+    # last id of the previous page
+    statement = select(*USER_EXPORT_COLUMNS).order_by(col(User.id))
+    if after_id is not None:
+        statement = statement.where(col(User.id) > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+async def stream_users(session: AsyncSession, after_id: int | None, chunk_size: int) -> AsyncIterator[list[dict[str, Any]]]:
+    # Rows come from a server side cursor chunk_size at a time, memory use does not depend on
+    # the number of users
+    statement = select_users(after_id).execution_options(yield_per=chunk_size)
+    result = await session.stream(statement)
+    async for rows in result.mappings().partitions():
+        yield [dict(row) for row in rows]
@@ -1,25 +1,40 @@
-from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from user_svc import settings
 
 #Create Engine
     # Engine is used to establish the connection between our app and our db (container or neon)
     # Engine is one for whole application
     # Psycopg translates Python code and data structures into commands and data formats that PostgreSQL understands, enabling seamless interaction between your application and the database.
+    # The async engine lets concurrent requests wait on the database without blocking the event loop,
+    # psycopg 3 provides the async driver for the same "postgresql+psycopg" url.
 connection_string: str = str(settings.DATABASE_URL).replace("postgresql", "postgresql+psycopg")
-engine = create_engine(connection_string, pool_recycle=300, pool_size=10, echo=True) 
+engine = create_async_engine(connection_string, pool_recycle=300, pool_size=settings.DB_POOL_SIZE,
+                             max_overflow=settings.DB_MAX_OVERFLOW, pool_timeout=settings.DB_POOL_TIMEOUT,
+                             pool_pre_ping=True, echo=settings.DB_ECHO)
     #Echo shows all the steps performed in the terminal
 
 # engine = create_engine(setting.DATABASE_URL)
 
 #Create tables
-def create_tables():
-    SQLModel.metadata.create_all(engine)
+def _create_tables(connection):
+    SQLModel.metadata.create_all(connection)
+    # create_all skips tables that already exist, make sure indexes added later are there too
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+async def create_tables():
+    async with engine.begin() as connection:
+        await connection.run_sync(_create_tables)
 
 #Create Session
     # for every fuction/transaction there will be a new session
     # E.g for every new logged in user, a new session is made
     # when user logs out, session closes
     # we are creating our session in a generator function so it closes the session automatically whenever we dont need it
-def get_session():
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+    # Objects stay loaded after commit, an async session cannot lazily reload expired attributes
+async def get_session():
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
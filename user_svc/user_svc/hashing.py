@@ -0,0 +1,82 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import math
+import multiprocessing
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from user_svc.settings import BCRYPT_ROUNDS, PASSWORD_HASH_QUEUE_TIMEOUT, PASSWORD_HASH_WORKERS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# min = max = default rounds makes every hash with another cost "need an update",
+# so changing BCRYPT_ROUNDS migrates users on their next login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor: ProcessPoolExecutor | None = None
+_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+
+
+# Run inside the worker processes. This module only imports passlib and the settings, but a
+# spawned worker also re-imports the __main__ module of the parent: entry points that start the
+# pool (import_users) import the database inside a function, so workers create no engine.
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _hash_many(passwords: list[str]) -> list[str]:
+    return [pwd_context.hash(password) for password in passwords]
+
+def _verify_and_update(password: str, password_hash: str) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+def start_pool():
+    global _executor
+    _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    logger.info(f"Password hashing pool started with {PASSWORD_HASH_WORKERS} workers")
+
+def shutdown_pool():
+    global _executor
+    if _executor:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+async def _run(func, *args):
+    try:
+        await asyncio.wait_for(_slots.acquire(), PASSWORD_HASH_QUEUE_TIMEOUT)
+    except TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please try again",
+            headers={"Retry-After": "1"}
+        )
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _slots.release()
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+async def verify_password(password: str, password_hash: str) -> tuple[bool, str | None]:
+    # Returns whether the password matches and, if the stored hash uses outdated
+    # parameters, a new hash to store in its place
+    return await _run(_verify_and_update, password, password_hash)
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    # For bulk imports: the batch is split into one chunk per worker, without the request slots
+    if not passwords:
+        return []
+    loop = asyncio.get_running_loop()
+    size = math.ceil(len(passwords) / PASSWORD_HASH_WORKERS)
+    chunks = await asyncio.gather(*(loop.run_in_executor(_executor, _hash_many, passwords[i:i + size])
+                                    for i in range(0, len(passwords), size)))
+    return [password_hash for chunk in chunks for password_hash in chunk]
@@ -0,0 +1,147 @@
+# Bulk import of users, e.g. when migrating an existing customer base. Run next to the service:
+#   python -m user_svc.import_users users.csv
+#   python -m user_svc.import_users users.ndjson --batch-size 2000
+# CSV files need a header row with username,email,password, NDJSON files one such object per line.
+# Passwords are plain text in the file and hashed with the configured BCRYPT_ROUNDS.
+import argparse
+import asyncio
+import csv
+from dataclasses import dataclass
+from itertools import islice
+import json
+import logging
+from typing import Any, Iterator
+
+from pydantic import ValidationError
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from user_svc import hashing
+from user_svc.models import Register_User, User
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+@dataclass
+class ImportResult:
+    received: int = 0
+    imported: int = 0
+    conflicts: int = 0
+    invalid: int = 0
+
+
+def read_rows(path: str) -> Iterator[tuple[int, Any]]:
+    # (line number, row), streamed so the file is never held in memory
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+
+def valid_users(rows: Iterator[tuple[int, Any]], result: ImportResult) -> Iterator[Register_User]:
+    for line_number, row in rows:
+        result.received += 1
+        try:
+            if isinstance(row, Exception):
+                raise ValueError(row)
+            user = Register_User.model_validate(row)
+            if not (user.username and user.email and user.password):
+                raise ValueError("username, email and password are required")
+        except (ValueError, ValidationError) as e:
+            result.invalid += 1
+            logger.warning(f"Skipping line {line_number}: {e}")
+            continue
+        yield user
+
+def batches(users: Iterator[Register_User], size: int) -> Iterator[list[Register_User]]:
+    while batch := list(islice(users, size)):
+        yield batch
+
+async def remove_conflicts(session: AsyncSession, batch: list[Register_User], result: ImportResult) -> list[Register_User]:
+    # One query per batch finds the usernames and emails that are taken, duplicates within the
+    # batch keep their first row. Conflicting rows are dropped before any hashing is done.
+    usernames = {user.username for user in batch}
+    emails = {user.email for user in batch}
+    statement = select(User.username, User.email).where(
+        or_(col(User.username).in_(usernames), col(User.email).in_(emails)))
+    taken_usernames = set()
+    taken_emails = set()
+    for username, email in (await session.exec(statement)).all():
+        taken_usernames.add(username)
+        taken_emails.add(email)
+
+    accepted = []
+    for user in batch:
+        if user.username in taken_usernames or user.email in taken_emails:
+            result.conflicts += 1
+            continue
+        taken_usernames.add(user.username)
+        taken_emails.add(user.email)
+        accepted.append(user)
+    return accepted
+
+async def insert_users(session: AsyncSession, batch: list[Register_User], password_hashes: list[str],
+                       result: ImportResult):
+    if not batch:
+        return
+    # A row registered or imported since the conflict check is skipped by the database
+    statement = insert(User).values([
+        {"username": user.username, "email": user.email, "password": password_hash}
+        for user, password_hash in zip(batch, password_hashes)
+    ]).on_conflict_do_nothing().returning(col(User.id))
+    inserted = len((await session.exec(statement)).all())
+    await session.commit()
+    result.imported += inserted
+    result.conflicts += len(batch) - inserted
+
+async def import_users(path: str, batch_size: int = BATCH_SIZE) -> ImportResult:
+    # Hashing a batch in the process pool overlaps with inserting the previous one.
+    # Spawned hash workers re-import this module as __main__, importing the database here keeps
+    # them from creating an engine of their own.
+    from user_svc.db import create_tables, engine
+    result = ImportResult()
+    await create_tables()
+    hashing.start_pool()
+    pending: tuple[list[Register_User], asyncio.Future] | None = None
+    try:
+        async with AsyncSession(engine) as session:
+            for batch in batches(valid_users(read_rows(path), result), batch_size):
+                batch = await remove_conflicts(session, batch, result)
+                password_hashes = asyncio.ensure_future(hashing.hash_passwords([user.password for user in batch]))
+                if pending:
+                    await insert_users(session, pending[0], await pending[1], result)
+                    logger.info(f"{result.received} rows read, {result.imported} users imported")
+                pending = (batch, password_hashes)
+            if pending:
+                await insert_users(session, pending[0], await pending[1], result)
+    finally:
+        if pending and not pending[1].done():
+            pending[1].cancel()
+        hashing.shutdown_pool()
+        await engine.dispose()
+    logger.info(f"Import finished: {result}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import users from a CSV or NDJSON file")
+    parser.add_argument("path", help="CSV file (.csv) with a header row, or NDJSON")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    asyncio.run(import_users(args.path, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import logging
+import os
+from dataclasses import dataclass
+from functools import cache
+from typing import Any
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import jwk, jwt, JWTError
+from user_svc.settings import JWT_ACTIVE_KID, JWT_ALGORITHM, JWT_KEYS_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SigningKey:
+    kid: str
+    algorithm: str
+    private_key: Any
+    public_key: Any
+
+    def public_jwk(self) -> dict[str, Any]:
+        return {**self.public_key.to_dict(), "kid": self.kid, "use": "sig"}
+
+
+def _generate_pem(algorithm: str) -> bytes:
+    if algorithm == "ES256":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    elif algorithm == "RS256":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        raise ValueError(f"Unsupported JWT algorithm {algorithm}, use ES256 or RS256")
+    return private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+def _create_active_key():
+    path = os.path.join(JWT_KEYS_DIR, f"{JWT_ACTIVE_KID}.pem")
+    os.makedirs(JWT_KEYS_DIR, exist_ok=True)
+    try:
+        # O_EXCL: when several workers start at once only one of them writes the key
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, "wb") as file:
+        file.write(_generate_pem(JWT_ALGORITHM))
+    logger.info(f"Generated {JWT_ALGORITHM} signing key {JWT_ACTIVE_KID}")
+
+def _load_key(kid: str, pem: bytes) -> SigningKey:
+    loaded = serialization.load_pem_private_key(pem, password=None)
+    algorithm = "ES256" if isinstance(loaded, ec.EllipticCurvePrivateKey) else "RS256"
+    private_key = jwk.construct(pem, algorithm)
+    return SigningKey(kid=kid, algorithm=algorithm, private_key=private_key, public_key=private_key.public_key())
+
+@cache
+def get_keys() -> dict[str, SigningKey]:
+    # All keys of the directory by kid, loaded once per process
+    _create_active_key()
+    keys = {}
+    for name in sorted(os.listdir(JWT_KEYS_DIR)):
+        if name.endswith(".pem"):
+            with open(os.path.join(JWT_KEYS_DIR, name), "rb") as file:
+                keys[name[:-len(".pem")]] = _load_key(name[:-len(".pem")], file.read())
+    return keys
+
+
+def sign(claims: dict[str, Any]) -> str:
+    key = get_keys()[JWT_ACTIVE_KID]
+    return jwt.encode(claims, key.private_key, algorithm=key.algorithm, headers={"kid": key.kid})
+
+def decode(token: str, legacy_secret: str | None = None, legacy_algorithm: str | None = None) -> dict[str, Any]:
+    # Verifies a token signed with one of our keys. Tokens issued before asymmetric signing
+    # (no kid, HMAC signed) are verified with legacy_secret if the caller still accepts them.
+    header = jwt.get_unverified_header(token)
+    kid = header.get("kid")
+    if kid is None and legacy_secret and legacy_algorithm and header.get("alg") == legacy_algorithm:
+        return jwt.decode(token, legacy_secret, algorithms=[legacy_algorithm])
+    key = get_keys().get(kid)
+    if key is None:
+        raise JWTError("Unknown signing key")
+    return jwt.decode(token, key.public_key, algorithms=[key.algorithm])
+
+def jwks() -> dict[str, list[dict[str, Any]]]:
+    return {"keys": [key.public_jwk() for key in get_keys().values()]}
@@ -1,12 +1,19 @@
+import asyncio
+import json
 import logging
 from contextlib import asynccontextmanager
-from typing import Annotated, List
+import time
+from typing import Annotated, Any, List
 # from aiokafka import AIOKafkaProducer
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session, select
-from user_svc import auth
-from user_svc.db import get_session, create_tables
+from sqlmodel.ext.asyncio.session import AsyncSession
+from user_svc import auth, hashing, keys, ratelimit, tokens
+from user_svc.cache import profile_cache, user_cache
+from user_svc.settings import ADMIN_USERNAMES
+from user_svc.crud import select_users, stream_users
+from user_svc.db import engine, get_session, create_tables
 from user_svc.models import Profile, ProfileData, ProfileResponse, Register_User, Token, TokenData, User
 from fastapi.security import OAuth2PasswordBearer
 # #Added below
@@ -17,7 +24,7 @@ from fastapi.middleware.cors import CORSMiddleware
 # This can lead to sensitive user data being exposed if not properly secured.
 # Therefore, I directly store and retrieve data from the database in the microservice without any kafka communication.
 # Kafka maybe used for token based authentication to communicate with other microservices.
-from jose import jwt, JWTError
+from jose import JWTError
 from dotenv import load_dotenv
 import os
 
@@ -28,38 +35,114 @@ EXPIRY_TIME = int(os.getenv('EXPIRY_TIME'))
 REFRESH_EXPIRY_DAYS = int(os.getenv('REFRESH_EXPIRY_DAYS'))
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
-def current_user(
-        token: Annotated[str, Depends(oauth_scheme)],
-        session: Annotated[Session, Depends(get_session)]
-) -> User:
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
 
-    credential_exception = HTTPException(
+def credential_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid token, Please login again",
         headers={"www-Authenticate": "Bearer"}
     )
+
+async def verify_access_token(token: str, session: AsyncSession) -> tuple[TokenData, dict]:
     try:
-        payload = jwt.decode(token, SECRET_KEY, ALGORITHM)
+        payload = auth.decode_token(token, "access")
         username: str | None = payload.get("sub")
         if username is None:
-            raise credential_exception
-        token_data = TokenData(username=username)
+            raise credential_exception()
     except JWTError:
-        raise credential_exception
-    user = auth.get_user_from_db(session, username=token_data.username)
+        raise credential_exception()
+    # Logging out revokes the token family, which ends its access tokens too. The check is
+    # in memory, the database is only asked in the rare case the revocation set cannot tell.
+    family_id: str | None = payload.get("fam")
+    if family_id and await tokens.is_revoked(session, family_id):
+        raise credential_exception()
+    return TokenData(username=username), payload
+
+def cache_user(user: User, generation: int, payload: dict):
+    # A detached copy is cached, valid no longer than the token it was loaded for
+    user_cache.put(user.username, User.model_validate(user), generation,
+                   ttl_seconds=payload.get("exp", 0) - time.time())
+
+async def current_user(
+        token: Annotated[str, Depends(oauth_scheme)],
+        session: Annotated[AsyncSession, Depends(get_session)]
+) -> User:
+    token_data, payload = await verify_access_token(token, session)
+
+    # The token was verified above, only the user lookup is cached
+    cached_user: User | None = user_cache.get(token_data.username)
+    if cached_user:
+        return cached_user
+    generation = user_cache.generation
+    user = await auth.get_user_from_db(session, username=token_data.username)
     if not user:
-        raise credential_exception
+        raise credential_exception()
+    cache_user(user, generation, payload)
     return user
 
+async def load_user_profile(
+        session: AsyncSession,
+        token_data: TokenData,
+        payload: dict,
+        cached_user: User | None
+) -> tuple[User, Profile | None]:
+    # One query either way: the profile by user_id when the user is cached, otherwise both joined.
+    # A detached copy of the profile is cached for /profile/me.
+    profile_generation = profile_cache.generation
+    if cached_user:
+        user, profile = cached_user, await auth.get_user_data_from_db(session, cached_user.id)
+    else:
+        generation = user_cache.generation
+        row = await auth.get_user_with_profile(session, token_data.username)
+        if not row:
+            raise credential_exception()
+        user, profile = row
+        cache_user(user, generation, payload)
+    if profile:
+        profile_cache.put(user.id, Profile.model_validate(profile), profile_generation)
+    return user, profile
+
+async def current_user_profile(
+        token: Annotated[str, Depends(oauth_scheme)],
+        session: Annotated[AsyncSession, Depends(get_session)]
+) -> tuple[User, Profile | None]:
+    # The profile write endpoints change the profile loaded into their session, so it always
+    # comes from the database
+    token_data, payload = await verify_access_token(token, session)
+    return await load_user_profile(session, token_data, payload, user_cache.get(token_data.username))
+
+async def cached_user_profile(
+        token: Annotated[str, Depends(oauth_scheme)],
+        session: Annotated[AsyncSession, Depends(get_session)]
+) -> tuple[User, Profile | None]:
+    # Read-only: served without the database when both the user and the profile are cached
+    token_data, payload = await verify_access_token(token, session)
+    cached_user: User | None = user_cache.get(token_data.username)
+    if cached_user:
+        cached_profile: Profile | None = profile_cache.get(cached_user.id)
+        if cached_profile:
+            return cached_user, cached_profile
+    return await load_user_profile(session, token_data, payload, cached_user)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print('Creating Tables')
-    create_tables()
+    await create_tables()
     print("Tables Created")
+    # Loads the signing keys, generating the active one on first start
+    keys.get_keys()
+    hashing.start_pool()
+    revocation_sync = asyncio.create_task(tokens.sync_revocations_forever())
     yield
+    revocation_sync.cancel()
+    await asyncio.gather(revocation_sync, return_exceptions=True)
+    hashing.shutdown_pool()
 
 app: FastAPI = FastAPI(
     lifespan=lifespan, title="User Management Service", version='1.0.0')
@@ -84,67 +167,85 @@ app.add_middleware(
 async def root():
     return {"message": "User Management Service"}
 
+# public keys for verifying the tokens issued here, other services cache this response
+@app.get('/.well-known/jwks.json')
+async def jwks(response: Response) -> dict:
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return keys.jwks()
+
 # login
 @app.post('/token', response_model=Token)
 async def login(
+    request: Request,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ) -> Token:
-    user: User | None = auth.authenticate_user(
+    await ratelimit.limit("login", request, form_data.username)
+    user: User | None = await auth.authenticate_user(
         form_data.username, form_data.password, session)
     if user is None:
         raise HTTPException(
             status_code=401, detail="Invalid username or password")
     else:
-        return auth.token_service(user)
+        return await auth.token_service(session, user)
 
 # get access token and refresh token
 @app.post("/token/refresh", response_model=Token)
-def refresh_token(
+async def refresh_token(
     old_refresh_token: str,
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ) -> Token:
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid token, Please login again",
         headers={"www-Authenticate": "Bearer"}
     )
-    user: User = auth.validate_refresh_token(old_refresh_token, session)
+    user, family_id = await auth.validate_refresh_token(old_refresh_token, session)
     if not user:
         raise credential_exception
-    return auth.token_service(user)
+    return await auth.token_service(session, user, family_id)
+
+# logout: revoke the refresh token and every token issued from the same login
+@app.post("/token/revoke")
+async def revoke_token(
+    refresh_token: str,
+    session: Annotated[AsyncSession, Depends(get_session)]
+) -> dict[str, str]:
+    await auth.revoke_refresh_token(refresh_token, session)
+    return {"message": "Token revoked successfully"}
 
 # register new user
 @app.post("/register")
 async def regiser_user(
+    request: Request,
     new_user: Annotated[Register_User, Depends()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ):
+    await ratelimit.limit("register", request, new_user.username)
     logger.info(f"new_user: {new_user}")
-    db_user = auth.get_user_from_db(session, new_user.username, new_user.email)
+    db_user = await auth.get_user_from_db(session, new_user.username, new_user.email)
     if db_user:
         raise HTTPException(
             status_code=409, detail="User with these credentials already exists")
     user = User(username=new_user.username,
                 email=new_user.email,
-                password=auth.hash_password(new_user.password))
+                password=await auth.hash_password(new_user.password))
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    await session.refresh(user)
     return {"message": f""" User with username:{user.username} successfully registered """}
 
 # create user profile
 @app.post('/profile', response_model=ProfileResponse)
 async def create_user_profile(
-    curr_user: Annotated[User, Depends(current_user)],
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(current_user_profile)],
     user_data: ProfileData,
-    session: Annotated[Session, Depends(get_session)],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ) -> Profile:
+    curr_user, existing_profile = user_and_profile
     print(f"current_user: {curr_user}")
     """ Create user profile """
     try:
-        existing_profile: Profile | None = auth.get_user_data_from_db(
-            session, curr_user.username)
         if existing_profile:
             raise HTTPException(
                 status_code=409, detail="User profile already exists. Try editing it")
@@ -157,8 +258,9 @@ async def create_user_profile(
             shipping_address=user_data.shipping_address
         )
         session.add(new_profile)
-        session.commit()
-        session.refresh(new_profile)
+        await session.commit()
+        await session.refresh(new_profile)
+        profile_cache.write(curr_user.id, Profile.model_validate(new_profile))
         print(new_profile)
         return new_profile
     
@@ -171,14 +273,13 @@ async def create_user_profile(
 # store payment token in database and send message to kafka
 @app.post("/profile/payment_info")
 async def store_payment_token(
-    curr_user: Annotated[User, Depends(current_user)],
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(current_user_profile)],
     payment_token: str,
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ):
     """ Store payment token in database """
     try:
-        existing_profile: Profile | None = auth.get_user_data_from_db(
-            session, curr_user.username)
+        _, existing_profile = user_and_profile
         if not existing_profile:
             raise HTTPException(
                 status_code=409, detail="User Profile not found. Try creating it")
@@ -186,8 +287,9 @@ async def store_payment_token(
         # store payment token in database
         existing_profile.payment_token = payment_token
         session.add(existing_profile)
-        session.commit()
-        session.refresh(existing_profile)
+        await session.commit()
+        await session.refresh(existing_profile)
+        profile_cache.write(existing_profile.user_id, Profile.model_validate(existing_profile))
 
         return {
             "message": "Payment token stored successfully"
@@ -199,12 +301,10 @@ async def store_payment_token(
 # get user profile
 @app.get('/profile/me', response_model=ProfileResponse)
 async def get_user_profile(
-    curr_user: Annotated[User, Depends(current_user)],
-    session: Annotated[Session, Depends(get_session)]
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(cached_user_profile)]
 ) -> Profile:
     """ Get user profile """
-    user_profile: Profile | None = auth.get_user_data_from_db(
-        session, curr_user.username)
+    _, user_profile = user_and_profile
     if not user_profile:
         raise HTTPException(
             status_code=404, detail="User profile not found")
@@ -213,15 +313,14 @@ async def get_user_profile(
 # edit user profile
 @app.put('/profile', response_model=ProfileResponse)
 async def edit_user_profile(
-    curr_user: Annotated[User, Depends(current_user)],
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(current_user_profile)],
     user_data: ProfileData,
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ) -> Profile:
     """ Edit User Profile """
     try:
         # get existing profile from db
-        existing_profile: Profile | None = auth.get_user_data_from_db(
-            session, curr_user.username)
+        _, existing_profile = user_and_profile
         if not existing_profile:
             raise HTTPException(
                 status_code=404, detail="User profile not found")
@@ -231,8 +330,9 @@ async def edit_user_profile(
 
         # update user profile in database
         session.add(existing_profile)
-        session.commit()
-        session.refresh(existing_profile)
+        await session.commit()
+        await session.refresh(existing_profile)
+        profile_cache.write(existing_profile.user_id, Profile.model_validate(existing_profile))
         return existing_profile
     
     except HTTPException as httexcep:
@@ -244,14 +344,13 @@ async def edit_user_profile(
 # update payment_token
 @app.put("/profile/payment_info")
 async def update_payment_token(
-    curr_user: Annotated[User, Depends(current_user)],
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(current_user_profile)],
     payment_token: str,
-    session: Annotated[Session, Depends(get_session)]):
+    session: Annotated[AsyncSession, Depends(get_session)]):
     """ Update payment token """
     try:
         # get existing profile from db
-        existing_profile: Profile | None = auth.get_user_data_from_db(
-            session, curr_user.username)
+        _, existing_profile = user_and_profile
         if not existing_profile:
             raise HTTPException(
                 status_code=404, detail="User profile not found")
@@ -259,8 +358,9 @@ async def update_payment_token(
 
         # update user profile in database
         session.add(existing_profile)
-        session.commit()
-        session.refresh(existing_profile)
+        await session.commit()
+        await session.refresh(existing_profile)
+        profile_cache.write(existing_profile.user_id, Profile.model_validate(existing_profile))
         return {
             "message": "Payment token updated successfully"
         }
@@ -274,21 +374,21 @@ async def update_payment_token(
 # delete user profile
 @app.delete('/profile')
 async def delete_user_profile(
-    curr_user: Annotated[User, Depends(current_user)],
-    session: Annotated[Session, Depends(get_session)]
+    user_and_profile: Annotated[tuple[User, Profile | None], Depends(current_user_profile)],
+    session: Annotated[AsyncSession, Depends(get_session)]
 ) -> dict[str, str]:
     """ Delete User Profile """
     try:
         # get existing profile from db
-        existing_profile: Profile | None = auth.get_user_data_from_db(
-            session, curr_user.username)
+        _, existing_profile = user_and_profile
         if not existing_profile:
             raise HTTPException(
                 status_code=404, detail="User profile not found")
 
         # delete user profile from database
-        session.delete(existing_profile)
-        session.commit()
+        await session.delete(existing_profile)
+        await session.commit()
+        profile_cache.invalidate(existing_profile.user_id)
         return {"message": "User profile deleted successfully"}
     
     except HTTPException as httexcep:
@@ -298,21 +398,46 @@ async def delete_user_profile(
             status_code=500, detail=f"Failed to delete user profile: {e}")
     
 
-@app.get("/users", response_model=List[User])
+async def admin_user(curr_user: Annotated[User, Depends(current_user)]) -> User:
+    if curr_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Access forbidden")
+    return curr_user
+
+# Hit rates of the in-process caches and the state of the revocation set
+@app.get("/cache/stats", dependencies=[Depends(admin_user)])
+async def get_cache_stats() -> dict[str, Any]:
+    return {
+        "users": user_cache.stats(),
+        "profiles": profile_cache.stats(),
+        "revocations": tokens.revocations.stats(),
+    }
+
+# Users ordered by id, one page at a time. When the page is full the X-Next-Cursor header holds
+# the after_id of the next page. Only id, username and email are returned.
+@app.get("/users", dependencies=[Depends(admin_user)])
 async def get_all_users(
-    session: Annotated[Session, Depends(get_session)]
-    # current_user: Annotated[User, Depends(auth.current_user)]
-) -> List[User]:
-    """
-    Development-only endpoint to get all users.
-    This should be disabled or removed in production.
-    """
-    # if not current_user.is_admin:
-    #     raise HTTPException(status_code=403, detail="Access forbidden")
-    
-    users = session.exec(select(User)).all()
+    session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    after_id: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE
+) -> List[dict[str, Any]]:
+    users = [dict(row) for row in (await session.exec(select_users(after_id, limit))).mappings()]
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1]["id"])
     return users
 
+# All users (or everything after after_id) as NDJSON, read from a server side cursor
+@app.get("/users/stream", dependencies=[Depends(admin_user)])
+async def get_users_stream(after_id: int | None = None):
+
+    async def ndjson_users():
+        # The response outlives the request dependencies, so the stream owns its session
+        async with AsyncSession(engine) as session:
+            async for rows in stream_users(session, after_id, STREAM_CHUNK_SIZE):
+                yield "".join(json.dumps(row) + "\n" for row in rows)
+
+    return StreamingResponse(ndjson_users(), media_type="application/x-ndjson")
+
 # #*********************************************************************************************************************
 # #
 # # Comment Everything above for running the below testing code
@@ -1,7 +1,9 @@
 # For simplicity, I have dropped the idea of using a is_seller variable to differentiate a user as seller and buyer.
 # This is a mart project and there is only one seller for now and that is the Mart Owner or administrator.
 
+from datetime import datetime
 from typing import Annotated
+from sqlalchemy import DateTime
 from sqlmodel import SQLModel, Field
 from fastapi import Form
 
@@ -15,13 +17,29 @@ class User (SQLModel, table=True):
 # user profile data in database
 class Profile (SQLModel, table=True):
     username: str | None = Field(default = None, primary_key=True)
-    user_id: int | None = Field(default = None, foreign_key="user.id")
+    # Profiles are joined to their user on user_id
+    user_id: int | None = Field(default = None, foreign_key="user.id", index=True)
     name: str
     email: str
     phone: str
     shipping_address: str
     payment_token: str | None = Field(default = None, unique=True)
 
+# refresh tokens issued from one login form a family, reusing a rotated token or logging out
+# revokes the whole family
+class TokenFamily (SQLModel, table=True):
+    id: str = Field(primary_key=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    expires_at: datetime = Field(sa_type=DateTime(timezone=True))
+    revoked_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True), index=True)
+
+# every refresh token can be exchanged once, used_at is set when it is
+class RefreshToken (SQLModel, table=True):
+    jti: str = Field(primary_key=True)
+    family_id: str = Field(foreign_key="tokenfamily.id", index=True)
+    expires_at: datetime = Field(sa_type=DateTime(timezone=True))
+    used_at: datetime | None = Field(default=None, sa_type=DateTime(timezone=True))
+
 # response model when user requests for profile data
 class ProfileResponse (SQLModel):
     username: str | None = Field(default = None, primary_key=True)
@@ -0,0 +1,91 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import time
+from typing import Callable
+
+from fastapi import HTTPException, Request
+from user_svc.settings import (RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_MAX_BUCKETS,
+                               RATE_LIMIT_TRUST_FORWARDED, RATE_LIMIT_USERNAME_BURST,
+                               RATE_LIMIT_USERNAME_PER_MINUTE)
+
+
+Bucket = tuple[str, float, float]
+
+
+class RateLimitBackend(ABC):
+    # Storage of the token buckets. The in-memory backend limits each process on its own, a shared
+    # backend (e.g. Redis) implementing acquire() limits all processes together.
+    @abstractmethod
+    async def acquire(self, buckets: list[Bucket]) -> float:
+        # Takes a token from each (key, rate, burst) bucket, which holds up to burst tokens and
+        # refills with rate tokens per second. Either every bucket gives a token or none does, a
+        # rejected request does not drain the buckets that still had one. Returns 0 if the tokens
+        # were taken, else the seconds until all buckets have one.
+        ...
+
+
+def refill(bucket: tuple[float, float] | None, now: float, rate: float, burst: float) -> float:
+    # Tokens of a bucket stored as (tokens, timestamp), a new bucket starts full
+    if bucket is None:
+        return burst
+    tokens, updated = bucket
+    return min(burst, tokens + (now - updated) * rate)
+
+def wait_time(tokens: float, rate: float) -> float:
+    # Seconds until the bucket holds a whole token
+    return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+
+class InMemoryBackend(RateLimitBackend):
+    # One (tokens, timestamp) pair per key, refilled lazily when the key is used. At most
+    # max_buckets keys are kept; the least recently used bucket is dropped, which only forgets
+    # how throttled an idle key was.
+    def __init__(self, max_buckets: int, clock: Callable[[], float] = time.monotonic):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def acquire(self, buckets: list[Bucket]) -> float:
+        now = self.clock()
+        levels = [refill(self._buckets.get(key), now, rate, burst) for key, rate, burst in buckets]
+        retry_after = max((wait_time(tokens, rate) for tokens, (_, rate, _) in zip(levels, buckets)), default=0.0)
+        for (key, _, _), tokens in zip(buckets, levels):
+            self._buckets[key] = (tokens - 1 if retry_after == 0 else tokens, now)
+            self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+def check_limits(limits: dict[str, float]):
+    # A rate of 0 would never refill a bucket, a burst below 1 never holds a whole token
+    for name, value in limits.items():
+        if value <= 0 or (name.endswith("_BURST") and value < 1):
+            raise ValueError(f"{name} must be greater than {1 if name.endswith('_BURST') else 0}, got {value}")
+
+
+check_limits({
+    "RATE_LIMIT_IP_PER_MINUTE": RATE_LIMIT_IP_PER_MINUTE,
+    "RATE_LIMIT_IP_BURST": RATE_LIMIT_IP_BURST,
+    "RATE_LIMIT_USERNAME_PER_MINUTE": RATE_LIMIT_USERNAME_PER_MINUTE,
+    "RATE_LIMIT_USERNAME_BURST": RATE_LIMIT_USERNAME_BURST,
+})
+backend: RateLimitBackend = InMemoryBackend(RATE_LIMIT_MAX_BUCKETS)
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+async def limit(action: str, request: Request, username: str):
+    # Called before any password is hashed or verified, a throttled request costs no bcrypt work
+    retry_after = await backend.acquire([
+        (f"{action}:ip:{client_ip(request)}", RATE_LIMIT_IP_PER_MINUTE / 60, RATE_LIMIT_IP_BURST),
+        (f"{action}:user:{username.lower()}", RATE_LIMIT_USERNAME_PER_MINUTE / 60, RATE_LIMIT_USERNAME_BURST),
+    ])
+    if retry_after > 0:
+        raise HTTPException(status_code=429, detail="Too many attempts, try again later",
+                            headers={"Retry-After": str(int(retry_after) + 1)})
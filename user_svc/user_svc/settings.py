@@ -1,5 +1,6 @@
+import os
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 try:
     config = Config(".env")
@@ -8,4 +9,61 @@ except FileNotFoundError:
     config = Config()
 
 DATABASE_URL = config("DATABASE_URL", cast=Secret)
-TEST_DATABASE_URL = config("TEST_DATABASE_URL", cast=Secret)
\ No newline at end of file
+TEST_DATABASE_URL = config("TEST_DATABASE_URL", cast=Secret)
+# Connection pool of the async engine. At most DB_POOL_SIZE + DB_MAX_OVERFLOW queries run at once,
+# a request waits at most DB_POOL_TIMEOUT seconds for a free connection.
+DB_POOL_SIZE = config("DB_POOL_SIZE", cast=int, default=10)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", cast=int, default=10)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", cast=float, default=30)
+# Logs every statement, costly under load
+DB_ECHO = config("DB_ECHO", cast=bool, default=False)
+
+# Password hashing runs in a pool of worker processes so bcrypt cannot block the event loop.
+# At most PASSWORD_HASH_WORKERS hashes run at once, a request waits at most
+# PASSWORD_HASH_QUEUE_TIMEOUT seconds for a slot before it is answered with 503.
+PASSWORD_HASH_WORKERS = config("PASSWORD_HASH_WORKERS", cast=int, default=os.cpu_count() or 1)
+PASSWORD_HASH_QUEUE_TIMEOUT = config("PASSWORD_HASH_QUEUE_TIMEOUT", cast=float, default=5)
+# Stored hashes with a different cost are rehashed on the next successful login
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", cast=int, default=12)
+
+# Users resolved from access tokens are cached per username. An entry never outlives the token it
+# was loaded for and is dropped when the user is changed.
+USER_CACHE_MAX_ENTRIES = config("USER_CACHE_MAX_ENTRIES", cast=int, default=10000)
+USER_CACHE_TTL_SECONDS = config("USER_CACHE_TTL_SECONDS", cast=float, default=60)
+# Profiles read by /profile/me are cached per user and replaced whenever this process changes them.
+# Changes made by other processes are seen after at most PROFILE_CACHE_TTL_SECONDS.
+PROFILE_CACHE_MAX_ENTRIES = config("PROFILE_CACHE_MAX_ENTRIES", cast=int, default=10000)
+PROFILE_CACHE_TTL_SECONDS = config("PROFILE_CACHE_TTL_SECONDS", cast=float, default=60)
+
+# Tokens are signed with the asymmetric key JWT_ACTIVE_KID (ES256 or RS256) stored as
+# JWT_KEYS_DIR/<kid>.pem. The key is generated on first start. To rotate, set a new kid: every key
+# left in the directory stays published at /.well-known/jwks.json, so tokens signed with an older
+# key stay valid until they expire.
+JWT_KEYS_DIR = config("JWT_KEYS_DIR", cast=str, default="keys")
+JWT_ACTIVE_KID = config("JWT_ACTIVE_KID", cast=str, default="key-1")
+JWT_ALGORITHM = config("JWT_ALGORITHM", cast=str, default="ES256")
+# Access tokens signed with the shared SECRET_KEY before asymmetric signing (no kid) are accepted
+# until JWT_LEGACY_CUTOVER plus EXPIRY_TIME minutes, by then every token issued before the switch
+# has expired. Set it to the time the asymmetric keys were deployed (ISO 8601, UTC unless an offset
+# is given). Empty, the default, rejects them.
+JWT_LEGACY_CUTOVER = config("JWT_LEGACY_CUTOVER", cast=str, default="")
+
+# Refresh tokens rotate on every use. Revoked token families are kept in memory (a bloom filter
+# plus the exact ids of at most REVOCATION_MAX_ENTRIES families) and synced from the database every
+# REVOCATION_SYNC_SECONDS, so checking a token does not query the database.
+REVOCATION_SYNC_SECONDS = config("REVOCATION_SYNC_SECONDS", cast=float, default=10)
+REVOCATION_MAX_ENTRIES = config("REVOCATION_MAX_ENTRIES", cast=int, default=100000)
+REVOCATION_BLOOM_ERROR_RATE = config("REVOCATION_BLOOM_ERROR_RATE", cast=float, default=0.001)
+
+# /token and /register are rate limited per client IP and per username with token buckets: BURST
+# attempts at once, refilled at PER_MINUTE. Throttled requests get 429 before any hashing is done.
+RATE_LIMIT_IP_PER_MINUTE = config("RATE_LIMIT_IP_PER_MINUTE", cast=float, default=30)
+RATE_LIMIT_IP_BURST = config("RATE_LIMIT_IP_BURST", cast=float, default=30)
+RATE_LIMIT_USERNAME_PER_MINUTE = config("RATE_LIMIT_USERNAME_PER_MINUTE", cast=float, default=5)
+RATE_LIMIT_USERNAME_BURST = config("RATE_LIMIT_USERNAME_BURST", cast=float, default=5)
+RATE_LIMIT_MAX_BUCKETS = config("RATE_LIMIT_MAX_BUCKETS", cast=int, default=100000)
+# Take the client IP from X-Forwarded-For, only behind a proxy that sets it
+RATE_LIMIT_TRUST_FORWARDED = config("RATE_LIMIT_TRUST_FORWARDED", cast=bool, default=False)
+
+# Users allowed to list and export all users, comma separated
+ADMIN_USERNAMES = config("ADMIN_USERNAMES", cast=CommaSeparatedStrings, default="")
@@ -0,0 +1,189 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import math
+import time
+from typing import Any
+import uuid
+
+from sqlalchemy import func
+from sqlmodel import col, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from user_svc.db import engine
+from user_svc.models import RefreshToken, TokenFamily
+from user_svc.settings import REVOCATION_BLOOM_ERROR_RATE, REVOCATION_MAX_ENTRIES, REVOCATION_SYNC_SECONDS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Revocations committed by other processes may carry a slightly older revoked_at than the last
+# one seen, every sync looks back this far
+SYNC_OVERLAP = timedelta(seconds=60)
+# The in-memory set is rebuilt from the database this often, dropping expired families
+REBUILD_INTERVAL = 3600
+
+
+class BloomFilter:
+    # Set membership without false negatives, sized for capacity items at the given error rate
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationSet:
+    # Revoked token families of this process. The bloom filter answers "not revoked" for almost
+    # every valid token, a hit is confirmed with the exact ids of the most recent revocations.
+    # Only when more than max_entries families are revoked can a hit be neither confirmed nor
+    # ruled out, then the caller asks the database.
+    def __init__(self, max_entries: int, error_rate: float):
+        self.max_entries = max_entries
+        self.error_rate = error_rate
+        self.synced_until: datetime | None = None
+        self.rebuilt_at = float("-inf")
+        self.hits = 0
+        self.database_checks = 0
+        self.reset(max_entries)
+
+    def reset(self, capacity: int):
+        self.bloom = BloomFilter(max(capacity, self.max_entries), self.error_rate)
+        self.recent: OrderedDict[str, None] = OrderedDict()
+        self.complete = True
+
+    def add(self, family_id: str):
+        self.bloom.add(family_id)
+        self.recent[family_id] = None
+        self.recent.move_to_end(family_id)
+        if len(self.recent) > self.max_entries:
+            self.recent.popitem(last=False)
+            self.complete = False
+
+    def check(self, family_id: str) -> bool | None:
+        # True if revoked, False if not, None if only the database knows
+        if family_id not in self.bloom:
+            return False
+        if family_id in self.recent:
+            self.hits += 1
+            return True
+        return False if self.complete else None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "revoked_families": len(self.recent),
+            "complete": self.complete,
+            "hits": self.hits,
+            "database_checks": self.database_checks,
+            "synced_until": self.synced_until,
+        }
+
+
+revocations = RevocationSet(REVOCATION_MAX_ENTRIES, REVOCATION_BLOOM_ERROR_RATE)
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+async def is_revoked(session: AsyncSession, family_id: str) -> bool:
+    revoked = revocations.check(family_id)
+    if revoked is None:
+        revocations.database_checks += 1
+        statement = select(TokenFamily.revoked_at).where(TokenFamily.id == family_id)
+        revoked = (await session.exec(statement)).first() is not None
+    return revoked
+
+async def add_refresh_token(session: AsyncSession, user_id: int, family_id: str | None,
+                            jti: str, expires_at: datetime) -> str:
+    # Part of the caller's transaction. Starts a new family for a login, otherwise extends the
+    # family's lifetime to the new token.
+    if family_id is None:
+        family_id = new_id()
+        session.add(TokenFamily(id=family_id, user_id=user_id, expires_at=expires_at))
+        # The models have no relationship to order the inserts by, the family must exist
+        # before its first token references it
+        await session.flush()
+    else:
+        await session.exec(update(TokenFamily).where(col(TokenFamily.id) == family_id).values(expires_at=expires_at))
+    session.add(RefreshToken(jti=jti, family_id=family_id, expires_at=expires_at))
+    return family_id
+
+async def use_refresh_token(session: AsyncSession, jti: str) -> str | None:
+    # Marks the token used and returns its family, all in one statement so two concurrent
+    # refreshes with the same token cannot both succeed. Returns None for an unknown, already used
+    # or revoked token; reuse of a rotated token revokes its family.
+    statement = (
+        update(RefreshToken)
+        .where(col(RefreshToken.jti) == jti,
+               col(RefreshToken.used_at).is_(None),
+               col(RefreshToken.family_id) == col(TokenFamily.id),
+               col(TokenFamily.revoked_at).is_(None))
+        .values(used_at=func.now())
+        .returning(col(RefreshToken.family_id))
+    )
+    family_id = (await session.exec(statement)).scalar()
+    if family_id is not None:
+        return family_id
+
+    token = await session.get(RefreshToken, jti)
+    if token is not None and token.used_at is not None:
+        logger.warning(f"Refresh token {jti} was reused, revoking family {token.family_id}")
+        await revoke_family(session, token.family_id)
+    return None
+
+async def revoke_family(session: AsyncSession, family_id: str):
+    # Commits, the revocation must be stored even if the caller's request fails afterwards
+    statement = (
+        update(TokenFamily)
+        .where(col(TokenFamily.id) == family_id, col(TokenFamily.revoked_at).is_(None))
+        .values(revoked_at=func.now())
+    )
+    await session.exec(statement)
+    await session.commit()
+    revocations.add(family_id)
+
+async def sync_revocations(session: AsyncSession):
+    # Incremental by revoked_at. Every REBUILD_INTERVAL the set is rebuilt from the families that
+    # have not expired yet, and expired rows are deleted.
+    rebuild = time.monotonic() - revocations.rebuilt_at >= REBUILD_INTERVAL
+    if rebuild:
+        # A family expires with its newest token, so its tokens are gone first
+        await session.exec(delete(RefreshToken).where(col(RefreshToken.expires_at) < func.now()))
+        await session.exec(delete(TokenFamily).where(col(TokenFamily.expires_at) < func.now()))
+        await session.commit()
+
+    statement = select(TokenFamily.id, TokenFamily.revoked_at).where(
+        col(TokenFamily.revoked_at).is_not(None), col(TokenFamily.expires_at) > func.now())
+    if not rebuild and revocations.synced_until is not None:
+        statement = statement.where(col(TokenFamily.revoked_at) > revocations.synced_until - SYNC_OVERLAP)
+    rows = (await session.exec(statement.order_by(col(TokenFamily.revoked_at)))).all()
+
+    if rebuild:
+        revocations.reset(len(rows) * 2)
+        revocations.rebuilt_at = time.monotonic()
+    for family_id, revoked_at in rows:
+        revocations.add(family_id)
+        revocations.synced_until = max(revocations.synced_until or revoked_at, revoked_at)
+
+async def sync_revocations_forever():
+    while True:
+        try:
+            async with AsyncSession(engine) as session:
+                await sync_revocations(session)
+        except Exception as e:
+            logger.error(f"Error syncing revoked refresh tokens: {e}")
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)